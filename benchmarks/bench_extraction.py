@@ -0,0 +1,39 @@
+import os
+import sys
+import time
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+from extraction import extract_all, extract_book_reference
+
+MESSAGES = [
+    "Tôi muốn đặt sách Nhà Giả Kim",
+    "Tên: Nguyễn Văn A, Số lượng: 2, SĐT: 0123456789, Địa chỉ: 12 Lê Lợi, Hà Nội",
+    "0987654321",
+    "tra cứu đơn hàng sdt 0912345678",
+    "Bạn có sách gì về lịch sử không?",
+    "mua hai cuốn Atomic Habits giao tới địa chỉ 45 Trần Hưng Đạo, Quận 1",
+    "Xin chào, hôm nay cửa hàng mở cửa đến mấy giờ?",
+    "Đặt cuốn thứ 2 cho tôi, tôi tên là Trần Thị B",
+]
+LAST_BOOKS = [{"book_id": i, "title": f"Sách {i}"} for i in range(1, 6)]
+
+
+def run(iterations=20000):
+    # Chạy một lượt để các pattern đã biên dịch nằm sẵn trong cache
+    for message in MESSAGES:
+        extract_all(message)
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for message in MESSAGES:
+            extract_all(message)
+            extract_book_reference(message, LAST_BOOKS)
+    elapsed = time.perf_counter() - start
+
+    total = iterations * len(MESSAGES)
+    print(f"Tin nhắn: {total}")
+    print(f"Tổng thời gian: {elapsed:.3f}s")
+    print(f"Trung bình: {elapsed / total * 1e6:.1f} µs/tin nhắn")
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,100 @@
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import threading
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+from database import BookStoreDB, OutOfStockError
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def worker(db, worker_id, book_ids, attempts, results, lock):
+    rng = random.Random(worker_id)
+    local = {"orders": 0, "ordered": 0, "rejected": 0, "latencies": []}
+
+    for attempt in range(attempts):
+        book_id = rng.choice(book_ids)
+        quantity = rng.randint(1, 3)
+        start = time.perf_counter()
+        try:
+            # Một nửa đi qua luồng giữ hàng như chatbot, nửa còn lại đặt trực tiếp
+            reservation_id = None
+            if attempt % 2:
+                reservation_id = db.reserve_stock(f"session-{worker_id}", book_id, quantity)
+            db.create_order(f"Khách {worker_id}", "0900000000", "Hà Nội", book_id, quantity,
+                            reservation_id=reservation_id)
+            local["orders"] += 1
+            local["ordered"] += quantity
+        except OutOfStockError:
+            local["rejected"] += 1
+        local["latencies"].append((time.perf_counter() - start) * 1000)
+
+    with lock:
+        for key in ("orders", "ordered", "rejected"):
+            results[key] += local[key]
+        results["latencies"].extend(local["latencies"])
+
+
+def run(threads, attempts, stock, books):
+    with tempfile.TemporaryDirectory() as tmp:
+        db = BookStoreDB(os.path.join(tmp, "storm.db"))
+        book_ids = [row[0] for row in db.get_connection().execute(
+            'SELECT book_id FROM books ORDER BY book_id LIMIT ?', (books,)
+        )]
+        with db.transaction() as cursor:
+            cursor.executemany('UPDATE books SET stock = ? WHERE book_id = ?',
+                               [(stock, book_id) for book_id in book_ids])
+        initial = stock * len(book_ids)
+
+        results = {"orders": 0, "ordered": 0, "rejected": 0, "latencies": []}
+        lock = threading.Lock()
+        pool = [
+            threading.Thread(target=worker, args=(db, i, book_ids, attempts, results, lock))
+            for i in range(threads)
+        ]
+
+        start = time.perf_counter()
+        for thread in pool:
+            thread.start()
+        for thread in pool:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        placeholders = ','.join('?' * len(book_ids))
+        remaining, negative = db.get_connection().execute(
+            f'SELECT SUM(stock), SUM(stock < 0) FROM books WHERE book_id IN ({placeholders})', book_ids
+        ).fetchone()
+        db.close()
+
+    latencies = results["latencies"]
+    print(f"Luồng: {threads}, lượt đặt: {len(latencies)}, sách: {len(book_ids)}, tồn kho ban đầu: {initial}")
+    print(f"Thành công: {results['orders']} đơn ({results['ordered']} quyển), từ chối do hết hàng: {results['rejected']}")
+    print(f"Thông lượng: {len(latencies) / elapsed:.0f} lượt/s")
+    print(f"Độ trễ: p50={percentile(latencies, 50):.2f}ms  p99={percentile(latencies, 99):.2f}ms  "
+          f"max={max(latencies):.2f}ms")
+
+    # Không bán vượt và không mất cập nhật: tồn kho còn lại khớp chính xác với số đã bán
+    consistent = remaining == initial - results["ordered"] and not negative
+    print(f"Tồn kho còn lại: {remaining} -> {'nhất quán' if consistent else 'KHÔNG NHẤT QUÁN'}")
+    return consistent
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Nhiều thread cùng đặt một nhóm nhỏ sách để kiểm tra bán vượt tồn kho")
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--attempts", type=int, default=200, help="Số lượt đặt của mỗi thread")
+    parser.add_argument("--stock", type=int, default=500, help="Tồn kho ban đầu của mỗi cuốn")
+    parser.add_argument("--books", type=int, default=3)
+    args = parser.parse_args()
+
+    sys.exit(0 if run(args.threads, args.attempts, args.stock, args.books) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.extend([ROOT, os.path.join(ROOT, 'src')])
+
+WORDS = [
+    "lịch sử", "tình yêu", "chiến tranh", "kinh tế", "tâm lý", "khoa học", "vũ trụ", "lập trình",
+    "thành công", "gia đình", "tuổi trẻ", "hạnh phúc", "biển", "núi", "thành phố", "làng quê",
+    "bí mật", "hành trình", "giấc mơ", "ký ức", "triết học", "nghệ thuật", "âm nhạc", "ẩm thực",
+    "đầu tư", "lãnh đạo", "kỹ năng", "giao tiếp", "sức khỏe", "thiên nhiên", "động vật", "trẻ em",
+    "mùa thu", "mùa đông", "ánh sáng", "bóng tối", "thời gian", "con đường", "người lính", "cô gái",
+]
+CATEGORIES = [
+    "Tiểu thuyết", "Phát triển bản thân", "Lịch sử", "Giáo dục", "Kinh tế",
+    "Khoa học", "Thiếu nhi", "Tâm lý", "Công nghệ", "Văn hóa",
+]
+FAMILY_NAMES = ["Nguyễn", "Trần", "Lê", "Phạm", "Hoàng", "Vũ", "Đặng", "Bùi", "Đỗ", "Hồ"]
+GIVEN_NAMES = ["An", "Bình", "Chi", "Dũng", "Hà", "Khoa", "Lan", "Minh", "Nam", "Thảo", "Tuấn", "Vy"]
+CHAT_TEMPLATES = [
+    "Tìm sách về {a}",
+    "Bạn có sách nào về {a} và {b} không?",
+    "Gợi ý sách {a} hay",
+    "Xin chào, cửa hàng mở cửa mấy giờ?",
+    "tra cứu đơn hàng sdt 0912345678",
+    "Có sách gì về {a} không?",
+]
+
+
+class StubOllamaClient:
+    # Thay ollama.Client: trả lời cố định, có thể giả lập độ trễ của model
+    latency = 0.0
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def _content(self, messages, format):
+        if format is not None:
+            from extraction import detect_intent
+            text = messages[-1]["content"] if messages else ""
+            result = detect_intent(text)
+            return json.dumps({
+                "intent": result["intent"], "confidence": 0.9,
+                "book_title": None, "quantity": None, "customer_name": None,
+                "phone": result["extracted_info"].get("phone"), "address": None, "search_query": None
+            })
+        return "Dưới đây là một vài cuốn sách phù hợp với yêu cầu của bạn, kèm giá và tình trạng còn hàng."
+
+    def chat(self, model=None, messages=None, format=None, stream=False, **kwargs):
+        time.sleep(self.latency)
+        content = self._content(messages, format)
+        if stream:
+            return ({"message": {"content": word + " "}} for word in content.split())
+        return {"message": {"content": content}}
+
+
+class StubOllamaAsyncClient(StubOllamaClient):
+    async def chat(self, model=None, messages=None, format=None, stream=False, **kwargs):
+        import asyncio
+        await asyncio.sleep(self.latency)
+        content = self._content(messages, format)
+        if stream:
+            async def parts():
+                for word in content.split():
+                    yield {"message": {"content": word + " "}}
+            return parts()
+        return {"message": {"content": content}}
+
+
+def generate_catalog(size, seed=0):
+    rng = random.Random(seed)
+    for i in range(size):
+        yield {
+            "title": " ".join(rng.sample(WORDS, rng.randint(2, 4))).capitalize() + f" {i}",
+            "author": f"{rng.choice(FAMILY_NAMES)} {rng.choice(GIVEN_NAMES)}",
+            "price": rng.randint(30, 500) * 1000,
+            "stock": rng.randint(0, 100),
+            "category": rng.choice(CATEGORIES),
+            "description": "Cuốn sách kể về " + ", ".join(rng.sample(WORDS, rng.randint(4, 8)))
+        }
+
+
+def make_queries(count, seed=1):
+    rng = random.Random(seed)
+    return [" ".join(rng.sample(WORDS, rng.randint(1, 2))) for _ in range(count)]
+
+
+def make_messages(count, seed=2):
+    rng = random.Random(seed)
+    return [rng.choice(CHAT_TEMPLATES).format(a=rng.choice(WORDS), b=rng.choice(WORDS)) for _ in range(count)]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def peak_rss_mb():
+    # ru_maxrss tính bằng KB trên Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(name, fn, inputs, warmup=5):
+    for item in inputs[:warmup]:
+        fn(item)
+
+    latencies = []
+    start = time.perf_counter()
+    for item in inputs:
+        call_start = time.perf_counter()
+        fn(item)
+        latencies.append((time.perf_counter() - call_start) * 1000)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "name": name,
+        "calls": len(inputs),
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+        "throughput": len(inputs) / elapsed,
+        "peak_rss_mb": peak_rss_mb()
+    }
+
+
+def run_worker(size, iterations, vector_max, llm_latency, output):
+    import ollama
+    import config
+    # Không đọc/ghi cache vector truy vấn của người dùng trong thư mục data
+    config.QUERY_CACHE_PATH = None
+    StubOllamaClient.latency = llm_latency / 1000
+    ollama.Client = StubOllamaClient
+    ollama.AsyncClient = StubOllamaAsyncClient
+
+    workdir = tempfile.mkdtemp(prefix="bookstore-bench-")
+    # BookStoreDB và EmbeddingManager dùng đường dẫn tương đối data/...
+    os.chdir(workdir)
+    try:
+        results = run_benchmarks(size, iterations, vector_max)
+    finally:
+        os.chdir(ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False)
+
+
+def run_benchmarks(size, iterations, vector_max):
+    import config
+    from database import BookStoreDB
+    from importer import chunked
+
+    results = {"size": size, "setup": {}, "benchmarks": []}
+
+    # Không nạp sách mẫu để số sách trong database đúng bằng size
+    db = BookStoreDB(seed=False)
+    start = time.perf_counter()
+    for books in chunked(generate_catalog(size), 10000):
+        db.insert_books(books)
+    results["setup"]["catalog_rows_per_sec"] = size / (time.perf_counter() - start)
+    db.close()
+
+    with_vectors = size <= vector_max
+    # Danh mục quá lớn để embed trong lúc benchmark: tắt hẳn tìm kiếm vector để không nạp model
+    # embedding và chỉ đo tìm kiếm văn bản
+    config.VECTOR_SEARCH_ENABLED = with_vectors
+
+    from chatbot import BookStoreChatbot
+    start = time.perf_counter()
+    bot = BookStoreChatbot()
+    bot.wait_until_ready()
+    results["setup"]["startup_s"] = time.perf_counter() - start
+    results["setup"]["vectors"] = with_vectors
+
+    rag_system = bot.rag_system
+    queries = make_queries(iterations)
+    rng = random.Random(3)
+    book_ids = [rng.randint(1, size) for _ in range(iterations)]
+    page_starts = [rng.randint(0, size) for _ in range(iterations)]
+
+    benchmarks = [
+        ("db.search_books", lambda q: rag_system.db.search_books(q, limit=20), queries),
+        ("db.search_books+filters",
+         lambda q: rag_system.db.search_books(q, limit=20, max_price=200000, in_stock=True), queries),
+        ("db.get_book_by_id", rag_system.db.get_book_by_id, book_ids),
+        ("db.get_books_page", lambda after: rag_system.db.get_books_page(after, 100), page_starts),
+        ("db.count_books_by_category", lambda _: rag_system.db.count_books_by_category(), queries[:20]),
+    ]
+    if with_vectors:
+        benchmarks.append((
+            "embedding.search_similar_books",
+            lambda q: rag_system.embedding_handler.search_similar_books(q, 10), queries
+        ))
+    benchmarks.append(("rag.retrieve_relevant_books", rag_system.retrieve_relevant_books, queries))
+
+    messages = make_messages(iterations)
+    turn = iter(range(len(messages) * 2))
+    benchmarks.append((
+        "chatbot.process_message",
+        lambda message: bot.process_message(message, session_id=f"bench-{next(turn) % 50}"), messages
+    ))
+
+    for name, fn, inputs in benchmarks:
+        results["benchmarks"].append(measure(name, fn, inputs))
+
+    results["setup"]["peak_rss_mb"] = peak_rss_mb()
+    return results
+
+
+def print_results(results):
+    setup = results["setup"]
+    print(f"\n=== {results['size']:,} sách | nạp {setup['catalog_rows_per_sec']:.0f} dòng/s | "
+          f"khởi động {setup['startup_s']:.1f}s | vector: {'có' if setup['vectors'] else 'bỏ qua'} | "
+          f"peak RSS {setup['peak_rss_mb']:.0f}MB ===")
+    print(f"{'benchmark':<32}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'ops/s':>12}{'RSS MB':>10}")
+    for bench in results["benchmarks"]:
+        print(f"{bench['name']:<32}{bench['p50_ms']:>10.2f}{bench['p95_ms']:>10.2f}{bench['p99_ms']:>10.2f}"
+              f"{bench['throughput']:>12.1f}{bench['peak_rss_mb']:>10.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark truy vấn, tìm kiếm và hội thoại trên danh mục sách tổng hợp")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 100000, 1000000])
+    parser.add_argument("--iterations", type=int, default=200, help="Số lần gọi cho mỗi benchmark")
+    parser.add_argument("--vector-max", type=int, default=100000,
+                        help="Chỉ embed danh mục có kích thước không vượt quá giá trị này")
+    parser.add_argument("--llm-latency-ms", type=float, default=0.0, help="Độ trễ giả lập của mỗi lần gọi LLM")
+    parser.add_argument("--json", help="Ghi kết quả ra file để so sánh giữa các lần chạy")
+    parser.add_argument("--worker", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--output", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker is not None:
+        run_worker(args.worker, args.iterations, args.vector_max, args.llm_latency_ms, args.output)
+        return
+
+    # Mỗi kích thước chạy trong một tiến trình riêng để peak RSS không bị cộng dồn
+    all_results = []
+    for size in args.sizes:
+        with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as f:
+            output = f.name
+        try:
+            process = subprocess.run([
+                sys.executable, os.path.abspath(__file__), "--worker", str(size),
+                "--iterations", str(args.iterations), "--vector-max", str(args.vector_max),
+                "--llm-latency-ms", str(args.llm_latency_ms), "--output", output
+            ], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+            if process.returncode != 0:
+                sys.exit(f"Benchmark {size} sách thất bại:\n{process.stderr[-4000:]}")
+            with open(output, encoding="utf-8") as f:
+                results = json.load(f)
+        finally:
+            os.remove(output)
+        print_results(results)
+        all_results.append(results)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(all_results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+import os
+import sys
+import time
+import argparse
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.extend([ROOT, os.path.join(ROOT, 'src')])
+from extraction import detect_intent
+from intent_classifier import EmbeddingIntentClassifier, load_utterances
+
+
+def split(utterances, holdout_every=5):
+    # Giữ lại mỗi câu thứ N của từng nhãn làm tập kiểm tra
+    train, test, seen = [], [], {}
+    for utterance in utterances:
+        index = seen.get(utterance["intent"], 0)
+        seen[utterance["intent"]] = index + 1
+        (test if index % holdout_every == 0 else train).append(utterance)
+    return train, test
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def evaluate(name, predict, test):
+    correct, escalated, latencies = 0, 0, []
+    for utterance in test:
+        start = time.perf_counter()
+        intent, used_llm = predict(utterance["text"])
+        latencies.append((time.perf_counter() - start) * 1000)
+        correct += intent == utterance["intent"]
+        escalated += used_llm
+
+    print(f"{name:<22} accuracy={correct / len(test):.1%}  llm_calls={escalated}/{len(test)}  "
+          f"p50={percentile(latencies, 50):.2f}ms  p95={percentile(latencies, 95):.2f}ms")
+
+
+def sweep_margins(classifier, test, margins):
+    # Chỉ các câu rule không chắc chắn mới tới bộ phân loại; tính độ chính xác trên câu được giữ lại
+    # cục bộ và tỉ lệ phải chuyển lên LLM cho từng ngưỡng
+    uncertain = [u for u in test if detect_intent(u["text"])["confidence"] < 0.7]
+    results = [classifier.classify(u["text"]) for u in uncertain]
+    expected = [u["intent"] for u in uncertain]
+    if not results:
+        print("Không có câu nào cần bộ phân loại cục bộ")
+        return
+
+    print(f"\n{'margin':>8}{'giữ lại':>10}{'đúng':>10}{'lên LLM':>10}")
+    for margin in margins:
+        kept = [(r, e) for r, e in zip(results, expected) if r["margin"] >= margin]
+        correct = sum(r["intent"] == e for r, e in kept)
+        accuracy = correct / len(kept) if kept else 0.0
+        print(f"{margin:>8.3f}{len(kept):>10}{accuracy:>10.1%}{(len(results) - len(kept)) / len(results):>10.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Đánh giá bộ phân loại ý định cục bộ so với luồng hiện tại")
+    parser.add_argument("--llm", action="store_true", help="Gọi thêm Ollama để so sánh với luồng rule + LLM")
+    parser.add_argument("--margins", type=float, nargs="+",
+                        help="Quét các ngưỡng INTENT_CLASSIFIER_MIN_MARGIN, ví dụ --margins 0.02 0.04 0.08 0.12")
+    args = parser.parse_args()
+
+    from embedding import EmbeddingManager
+    embedding_handler = EmbeddingManager(query_cache_path=None)
+    train, test = split(load_utterances())
+    classifier = EmbeddingIntentClassifier(embedding_handler).fit(train)
+    print(f"Huấn luyện: {len(train)} câu, kiểm tra: {len(test)} câu\n")
+
+    def rules(text):
+        return detect_intent(text)["intent"], False
+
+    def rules_embedding(text):
+        result = detect_intent(text)
+        if result["confidence"] >= 0.7:
+            return result["intent"], False
+        local = classifier.classify(text)
+        # Câu có độ chênh thấp sẽ được chuyển lên LLM trong thực tế
+        return local["intent"], not classifier.is_confident(local)
+
+    evaluate("rules", rules, test)
+    evaluate("rules + embedding", rules_embedding, test)
+
+    if args.margins:
+        sweep_margins(classifier, test, args.margins)
+
+    if args.llm:
+        from llm import OlamaLLM
+        llm = OlamaLLM()
+        llm.ready.wait()
+
+        def rules_llm(text):
+            result = detect_intent(text)
+            if result["confidence"] >= 0.7:
+                return result["intent"], False
+            llm_result = llm._llm_intent_detection(text)
+            best = llm_result if llm_result["confidence"] > result["confidence"] else result
+            return best["intent"], True
+
+        evaluate("rules + LLM", rules_llm, test)
+
+
+if __name__ == "__main__":
+    main()
@@ -10,15 +10,87 @@ CHROMA_DB_PATH = BASE_DIR / "chroma_db"
 CHROMA_COLLECTION_NAME = "books_collection"
 
 OLLAMA_MODEL = "llama3.1:8b"
+# Model nhỏ cho phân tích ý định và trích xuất JSON; đặt bằng OLLAMA_MODEL để chỉ dùng một model.
+# Cần OLLAMA_MAX_LOADED_MODELS >= 2 phía server Ollama để hai model cùng nằm trong bộ nhớ.
+OLLAMA_ANALYSIS_MODEL = "llama3.2:3b"
+# Thời gian Ollama giữ model trong bộ nhớ sau lần gọi cuối, gửi kèm mọi lời gọi để model không bị giải phóng giữa các lượt
+OLLAMA_KEEP_ALIVE = "30m"
+# Bộ lập lịch gọi LLM: số lời gọi đồng thời tới Ollama, thời gian chờ tối đa trong hàng đợi
+# và giới hạn tần suất mỗi session (token bucket: lời gọi/giây, số lời gọi dồn tối đa)
+LLM_MAX_CONCURRENT = 4
+LLM_QUEUE_TIMEOUT = 30
+LLM_SESSION_RATE = 1.0
+LLM_SESSION_BURST = 6
+# Hạn chót (giây) cho mỗi lời gọi Ollama: phân tích ý định/trích xuất JSON và sinh câu trả lời.
+# Lời gọi vượt quá nửa hạn chót được tính là chậm.
+LLM_ANALYSIS_TIMEOUT = 8
+LLM_GENERATION_TIMEOUT = 30
+# Circuit breaker: mở sau N lời gọi lỗi/chậm liên tiếp, thử lại sau RESET_TIMEOUT giây
+LLM_BREAKER_FAILURE_THRESHOLD = 5
+LLM_BREAKER_RESET_TIMEOUT = 20
+# Ngân sách token cho prompt (ước lượng theo số ký tự), số sách và độ dài lịch sử đưa vào prompt
+PROMPT_CHARS_PER_TOKEN = 3
+PROMPT_TOKEN_BUDGET_ANALYSIS = 600
+PROMPT_TOKEN_BUDGET_GENERATION = 800
+PROMPT_MAX_BOOKS = 5
+PROMPT_RECENT_TURN_CHARS = 240
+PROMPT_OLDER_TURN_CHARS = 80
 
 # OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 # OPENAI_MODEL = "gpt-4o-mini"
 
 SEARCH_TOP_K = 5
+# Kết hợp BM25 và vector bằng reciprocal-rank fusion: score = sum(weight / (RRF_K + rank))
+RRF_K = 60
+HYBRID_TEXT_WEIGHT = 1.0
+HYBRID_VECTOR_WEIGHT = 1.0
+# Mỗi nguồn lấy top_k * hệ số ứng viên trước khi kết hợp
+HYBRID_CANDIDATE_MULTIPLIER = 4
+VECTOR_SEARCH_WORKERS = 4
+VECTOR_SEARCH_ENABLED = True
+# Số đơn hàng gần nhất hiển thị khi tra cứu theo SĐT
+ORDER_STATUS_PAGE_SIZE = 10
+
+# Cache câu trả lời tìm kiếm do LLM sinh ra
+RESPONSE_CACHE_TTL = 600
+RESPONSE_CACHE_SIZE = 1024
   
 MAX_CONVERSATION_HISTORY = 10
 SESSION_TIMEOUT = 3600  
+MAX_SESSIONS = 10000
+# "memory" hoặc "sqlite" (giữ session qua các lần khởi động lại)
+SESSION_STORE = "memory"
+SESSION_DB_PATH = DATA_DIR / "sessions.db"
+
+# Server HTTP/WebSocket (src/server.py)
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 8000
+SERVER_MAX_CONCURRENT_TURNS = 32
+# Số lượt đang chờ tối đa, vượt quá thì trả 503 thay vì xếp hàng vô hạn
+SERVER_MAX_PENDING_TURNS = 128
+SERVER_REQUEST_TIMEOUT = 60
+SERVER_KEEP_ALIVE_TIMEOUT = 15
+SERVER_WS_IDLE_TIMEOUT = 300
+SERVER_MAX_BODY_BYTES = 64 * 1024
 EMBEDDING_MODEL = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+EMBEDDING_BATCH_SIZE = 64
+# "float32", "float16" (chỉ trên GPU) hoặc "int8" (lượng tử hóa động trên CPU)
+EMBEDDING_PRECISION = "float32"
+
+# Bộ phân loại ý định cục bộ, chỉ gọi LLM khi độ chênh giữa hai nhãn đầu nhỏ hơn ngưỡng
+INTENT_UTTERANCES_PATH = DATA_DIR / "intent_utterances.jsonl"
+# Ngưỡng tạm thời: chưa được hiệu chỉnh trên model embedding thật. Chạy
+# `python benchmarks/eval_intent.py --margins 0.02 0.04 0.06 0.08 0.1 0.12` với EMBEDDING_MODEL
+# đã tải và chọn ngưỡng nhỏ nhất còn giữ độ chính xác mong muốn trên các câu không lên LLM.
+INTENT_CLASSIFIER_MIN_MARGIN = 0.08
+
+# Cache vector của câu truy vấn (None để tắt lưu xuống đĩa)
+QUERY_CACHE_SIZE = 2048
+QUERY_CACHE_MAX_BYTES = 16 * 1024 * 1024
+QUERY_CACHE_PATH = DATA_DIR / "query_embeddings.npz"
+
+# Số dòng mỗi giao dịch khi nhập danh mục sách hàng loạt
+IMPORT_CHUNK_SIZE = 5000
 
 def create_directories():
   DATA_DIR.mkdir(parents=True, exist_ok=True)
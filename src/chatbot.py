@@ -1,7 +1,17 @@
 import sys, os
+import asyncio
+import inspect
+import weakref
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from rag import RAGSystem
 from llm import OlamaLLM
+from session_store import create_session_store
+from intent_classifier import EmbeddingIntentClassifier
+from database import OutOfStockError
+from llm_scheduler import current_session
+from extraction import (
+    extract_book_reference, extract_customer_info, extract_phone, extract_phone_only, extract_quantity
+)
 import config
 import logging
 import re
@@ -11,27 +21,55 @@ class BookStoreChatbot:
       print("Đang khởi tạo BookStore Chatbot...")
       
       self.rag_system = RAGSystem()
-      self.llm_handler = OlamaLLM()
+      self.llm_handler = OlamaLLM(
+          intent_classifier=EmbeddingIntentClassifier(self.rag_system.embedding_handler)
+      )
+      # Đơn hàng làm thay đổi tồn kho thì bỏ các câu trả lời đã cache có sách đó
+      self.rag_system.db.add_stock_listener(self.llm_handler.response_cache.invalidate_book)
       
-      self.conversation_state = {}
+      self.conversation_state = create_session_store()
+      # Khóa theo session để các tin nhắn của cùng một người dùng được xử lý tuần tự
+      self._session_locks = weakref.WeakValueDictionary()
+      # Session đang ghi đơn hàng/giữ hàng trên thread: bước này không dừng được khi lượt bị hủy
+      self._committing = set()
       
       logging.basicConfig(level=logging.INFO)
       self.logger = logging.getLogger(__name__)
       
       print("BookStore Chatbot đã sẵn sàng!")
   
-  def process_message(self, user_message, session_id = "default"):
+  def _get_session(self, session_id):
+        return self.conversation_state.get(session_id)
+    
+  def _get_session_lock(self, session_id):
+        lock = self._session_locks.get(session_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._session_locks[session_id] = lock
+        return lock
+    
+  def is_committing(self, session_id):
+        return session_id in self._committing
+    
+  async def _arun_commit(self, session_id, func, *args):
+        # Hủy lượt không dừng được thread đang ghi SQLite: shield để bước ghi luôn chạy xong,
+        # và chỉ bỏ đánh dấu khi thread thực sự kết thúc
+        future = asyncio.ensure_future(asyncio.to_thread(func, *args))
+        self._committing.add(session_id)
+        # Lượt có thể bị hủy trước khi thread xong: giữ session riêng cho thread đang ghi
+        self.conversation_state.acquire(session_id)
+        future.add_done_callback(lambda _: self._end_commit(session_id))
+        return await asyncio.shield(future)
+    
+  def _end_commit(self, session_id):
+        self._committing.discard(session_id)
+        self.conversation_state.release(session_id)
+    
+  def process_message(self, user_message, session_id = "default", on_token = None):
+        # Bộ lập lịch LLM đọc session hiện tại để giới hạn tần suất theo từng người dùng
+        session_token = current_session.set(session_id)
         try:
-            if session_id not in self.conversation_state:
-                self.conversation_state[session_id] = {
-                    "intent": None,
-                    "pending_order": None,
-                    "editing_fields": None,
-                    "last_books": [],
-                    "conversation_history": []
-                }
-            
-            session = self.conversation_state[session_id]
+            session = self.conversation_state.acquire(session_id)
             
             session["conversation_history"].append({
                 "role": "user",
@@ -47,35 +85,113 @@ class BookStoreChatbot:
                 response = self._handle_order_confirmation(user_message, session_id)
             else:
                 if intent_result["intent"] == "SEARCH":
-                    response = self._handle_search(user_message, intent_result, session_id)
+                    response = self._handle_search(user_message, intent_result, session_id, on_token)
                 elif intent_result["intent"] == "ORDER":
                     response = self._handle_order(user_message, intent_result, session_id)
                 elif intent_result["intent"] == "ORDER_STATUS":
                     response = self._handle_order_status(user_message, intent_result, session_id)
                 else:
-                    response = self._handle_general(user_message, session_id)
+                    response = self._handle_general(user_message, session_id, on_token)
             
             session["conversation_history"].append({
                 "role": "bot",
                 "message": response
             })
+            self.conversation_state.save(session_id)
             
             return response
                 
         except Exception as e:
             self.logger.error(f"Lỗi khi xử lý tin nhắn: {e}")
             return "Xin lỗi, có lỗi xảy ra. Bạn có thể thử lại không?"
+        finally:
+            self.conversation_state.release(session_id)
+            current_session.reset(session_token)
+    
+  async def aprocess_message(self, user_message, session_id = "default", on_token = None):
+        lock = self._get_session_lock(session_id)
+        session_token = current_session.set(session_id)
+        try:
+            return await self._aprocess_locked(lock, user_message, session_id, on_token)
+        finally:
+            current_session.reset(session_token)
+    
+  async def _aprocess_locked(self, lock, user_message, session_id, on_token):
+        async with lock:
+            try:
+                session = self.conversation_state.acquire(session_id)
+                
+                session["conversation_history"].append({
+                    "role": "user",
+                    "message": user_message
+                })
+                
+                intent_result = await self._aintent_classification(user_message, session)
+                session["intent"] = intent_result["intent"]
+                
+                # SQLite và Chroma là blocking, chạy ngoài event loop
+                if session.get("editing_fields"):
+                    response = self._handle_order_edit(user_message, session_id)
+                elif session.get("pending_order"):
+                    response = await self._arun_commit(session_id, self._handle_order_confirmation, user_message, session_id)
+                else:
+                    if intent_result["intent"] == "SEARCH":
+                        response = await self._ahandle_search(user_message, intent_result, session_id, on_token)
+                    elif intent_result["intent"] == "ORDER":
+                        response = await self._ahandle_order(user_message, intent_result, session_id)
+                    elif intent_result["intent"] == "ORDER_STATUS":
+                        response = await asyncio.to_thread(self._handle_order_status, user_message, intent_result, session_id)
+                    else:
+                        response = await self._ahandle_general(user_message, session_id, on_token)
+                
+                session["conversation_history"].append({
+                    "role": "bot",
+                    "message": response
+                })
+                await asyncio.to_thread(self.conversation_state.save, session_id)
+                
+                return response
+                    
+            except Exception as e:
+                self.logger.error(f"Lỗi khi xử lý tin nhắn: {e}")
+                return "Xin lỗi, có lỗi xảy ra. Bạn có thể thử lại không?"
+            finally:
+                self.conversation_state.release(session_id)
     
   def _intent_classification(self, user_message, session):
-        context = {
+        context = self._intent_context(session)
+        return self.llm_handler.enhanced_intent_classification(user_message, context)
+    
+  def _intent_context(self, session):
+        return {
             "last_books": session.get("last_books", []),
             "pending_order": session.get("pending_order"),
-            "conversation_history": session.get("conversation_history", [])[-3:]  # 3 tin nhắn gần nhất
+            # Prompt builder rút gọn các lượt cũ và cắt theo ngân sách token
+            "conversation_history": list(session.get("conversation_history", []))
         }
-        
-        return self.llm_handler.enhanced_intent_classification(user_message, context)
     
-  def _handle_search(self, user_message, intent_result, session_id):
+  async def _aintent_classification(self, user_message, session):
+        context = self._intent_context(session)
+        return await self.llm_handler.aenhanced_intent_classification(user_message, context)
+    
+  def _collect_stream(self, chunks, on_token):
+        parts = []
+        for chunk in chunks:
+            on_token(chunk)
+            parts.append(chunk)
+        return "".join(parts)
+    
+  async def _acollect_stream(self, chunks, on_token):
+        parts = []
+        async for chunk in chunks:
+            # on_token có thể là coroutine (ví dụ chờ socket drain) để tạo backpressure lên luồng sinh token
+            result = on_token(chunk)
+            if inspect.isawaitable(result):
+                await result
+            parts.append(chunk)
+        return "".join(parts)
+    
+  def _handle_search(self, user_message, intent_result, session_id, on_token = None):
         search_query = intent_result.get("extracted_info", {}).get("search_query", user_message)
         
         relevant_books = self.rag_system.retrieve_relevant_books(search_query)
@@ -85,47 +201,104 @@ class BookStoreChatbot:
         
         self.conversation_state[session_id]["last_books"] = relevant_books
         
+        if on_token:
+            return self._collect_stream(self.llm_handler.stream_search_response(search_query, relevant_books), on_token)
         return self.llm_handler.generate_search_response(search_query, relevant_books)
     
+  async def _ahandle_search(self, user_message, intent_result, session_id, on_token = None):
+        search_query = intent_result.get("extracted_info", {}).get("search_query", user_message)
+        
+        relevant_books = await asyncio.to_thread(self.rag_system.retrieve_relevant_books, search_query)
+        
+        if not relevant_books:
+            return "Xin lỗi, tôi không tìm thấy sách nào phù hợp trong cửa hàng."
+        
+        self.conversation_state[session_id]["last_books"] = relevant_books
+        
+        if on_token:
+            return await self._acollect_stream(self.llm_handler.astream_search_response(search_query, relevant_books), on_token)
+        return await self.llm_handler.agenerate_search_response(search_query, relevant_books)
+    
   def _handle_order(self, user_message, intent_result, session_id):
         session = self.conversation_state[session_id]
-        extracted_info = intent_result.get("extracted_info", {})
+        last_books = session.get("last_books", [])
+        extracted_info, referenced_book = self._rule_order_info(user_message, intent_result, last_books)
         
-        book_info = self._find_book_for_order_enhanced(user_message, extracted_info, session)
+        llm_info = {}
+        if self._needs_llm_extraction(intent_result, extracted_info, referenced_book):
+            llm_info = self.llm_handler.extract_order_info(user_message, last_books)
         
-        if not book_info:
-            return "Bạn muốn đặt sách nào? Vui lòng cho tôi biết tên sách cụ thể hoặc tìm kiếm sách trước."
+        book_info = self._find_book_for_order_enhanced(extracted_info, referenced_book, llm_info)
         
-        if book_info['stock'] <= 0:
-            return f"Xin lỗi, sách '{book_info['title']}' hiện đã hết hàng."
+        return self._finish_order(book_info, extracted_info, llm_info, session_id)
+    
+  async def _ahandle_order(self, user_message, intent_result, session_id):
+        session = self.conversation_state[session_id]
+        last_books = session.get("last_books", [])
+        extracted_info, referenced_book = self._rule_order_info(user_message, intent_result, last_books)
         
-        order_info = self._create_order_info_enhanced(book_info, extracted_info, user_message)
+        llm_info = {}
+        if self._needs_llm_extraction(intent_result, extracted_info, referenced_book):
+            llm_info = await self.llm_handler.aextract_order_info(user_message, last_books)
         
-        return self._process_order_workflow(order_info, session_id)
+        book_info = await asyncio.to_thread(self._find_book_for_order_enhanced, extracted_info, referenced_book, llm_info)
+        
+        # Giữ hàng cho đơn là một giao dịch ghi SQLite
+        return await self._arun_commit(session_id, self._finish_order, book_info, extracted_info, llm_info, session_id)
     
-  def _find_book_for_order_enhanced(self, user_message, extracted_info, session):
+  def _rule_order_info(self, user_message, intent_result, last_books):
+        extracted_info = dict(intent_result.get("extracted_info", {}))
+        
+        # Trích xuất bằng luật trước, chỉ gọi LLM cho phần còn thiếu
+        for key, value in extract_customer_info(user_message).items():
+            if value and not extracted_info.get(key):
+                extracted_info[key] = value
+        quantity = extract_quantity(user_message)
+        if quantity > 0 and not extracted_info.get('quantity'):
+            extracted_info['quantity'] = quantity
+        
+        return extracted_info, extract_book_reference(user_message, last_books)
+    
+  def _needs_llm_extraction(self, intent_result, extracted_info, referenced_book):
+        # Kết quả phân tích bằng LLM trong lượt này đã có đủ các trường, không gọi lại
+        if intent_result.get("source") == "llm":
+            return False
+        
+        has_book = extracted_info.get("book_title") or referenced_book
+        return not has_book or not all([extracted_info.get('quantity'), extracted_info.get('customer_name')])
+    
+  def _find_book_for_order_enhanced(self, extracted_info, referenced_book, llm_info):
         if extracted_info.get("book_title"):
             book_info = self.rag_system.find_book_for_order(extracted_info["book_title"])
             if book_info:
                 return book_info
         
-        referenced_book = self._extract_book_reference(user_message, session.get("last_books", []))
         if referenced_book:
             return referenced_book
         
-        enhanced_info = self.llm_handler.extract_order_info(user_message, session.get("last_books", []))
-        if enhanced_info.get("book_title"):
-            book_info = self.rag_system.find_book_for_order(enhanced_info["book_title"])
+        if llm_info.get("book_title"):
+            book_info = self.rag_system.find_book_for_order(llm_info["book_title"])
             if book_info:
                 return book_info
         
         return None
     
-  def _create_order_info_enhanced(self, book_info, extracted_info, user_message):
-        if not all([extracted_info.get('quantity'), extracted_info.get('customer_name')]):
-            enhanced_info = self.llm_handler.extract_order_info(user_message)
-            extracted_info.update({k: v for k, v in enhanced_info.items() if v})
+  def _finish_order(self, book_info, extracted_info, llm_info, session_id):
+        if not book_info:
+            return "Bạn muốn đặt sách nào? Vui lòng cho tôi biết tên sách cụ thể hoặc tìm kiếm sách trước."
+        
+        if book_info['stock'] <= 0:
+            return f"Xin lỗi, sách '{book_info['title']}' hiện đã hết hàng."
         
+        for key, value in llm_info.items():
+            if value and not extracted_info.get(key):
+                extracted_info[key] = value
+        
+        order_info = self._build_order_info(book_info, extracted_info)
+        
+        return self._process_order_workflow(order_info, session_id)
+    
+  def _build_order_info(self, book_info, extracted_info):
         return {
             'book_title': book_info['title'],
             'book_id': book_info['book_id'],
@@ -140,12 +313,12 @@ class BookStoreChatbot:
         phone = intent_result.get("extracted_info", {}).get("phone")
         
         if not phone:
-            phone = self._extract_phone_fallback(user_message)
+            phone = extract_phone_only(user_message) or extract_phone(user_message)
         
         if not phone:
             return "Vui lòng cung cấp số điện thoại để tra cứu đơn hàng."
         
-        orders = self.rag_system.db.get_orders_by_phone(phone)
+        orders, more = self.rag_system.db.get_orders_page(phone, limit=config.ORDER_STATUS_PAGE_SIZE)
         
         if not orders:
             return f"Không tìm thấy đơn hàng nào cho số điện thoại **{phone}**."
@@ -169,61 +342,10 @@ class BookStoreChatbot:
 - Ngày đặt: {order['created_at']}
 ────────────────────
 """
+        if more:
+            response += f"\nĐang hiển thị {len(orders)} đơn hàng gần nhất."
         return response
     
-  def _extract_phone_fallback(self, user_message):
-        clean_message = re.sub(r'\s+', '', user_message.strip())
-        
-        if re.fullmatch(r'(\+?[0-9]{10,12})', clean_message):
-            return clean_message
-        
-        phone_match = re.search(r'(\+?[0-9]{10,12})', user_message)
-        if phone_match:
-            return phone_match.group(1)
-        
-        return None
-    
-  def _extract_book_reference(self, user_message, last_books):
-    if not last_books:
-        return None
-        
-    message_lower = user_message.lower()
-    
-    number_patterns = [
-        (r'cuốn\s*(?:số\s*)?(\d+)', lambda m: int(m.group(1)) - 1),
-        (r'sách\s*(?:số\s*)?(\d+)', lambda m: int(m.group(1)) - 1),
-        (r'(?:thứ|số)\s*(\d+)', lambda m: int(m.group(1)) - 1),
-        (r'quyển\s*(\d+)', lambda m: int(m.group(1)) - 1),
-    ]
-    
-    for pattern, extractor in number_patterns:
-        match = re.search(pattern, message_lower)
-        if match:
-            try:
-                index = extractor(match)
-                if 0 <= index < len(last_books):
-                    return last_books[index]
-            except:
-                continue
-    
-    # Từ tham chiếu
-    ref_words = {
-        'này': 0, 'đó': 0, 'kia': 0, 'trên': 0, 
-        'đầu tiên': 0, 'đầu': 0, 'first': 0,
-        'thứ hai': 1, 'thứ 2': 1, 'second': 1,
-        'thứ ba': 2, 'thứ 3': 2, 'third': 2,
-        'cuối': -1, 'last': -1, 'cuối cùng': -1
-    }
-    
-    for word, index in ref_words.items():
-        if word in message_lower:
-            if index == -1:  # cuối cùng
-                return last_books[-1] if last_books else None
-            elif index < len(last_books):
-                return last_books[index]
-    
-    return None
-  
   def _process_order_workflow(self, order_info, session_id):
         session = self.conversation_state[session_id]
         
@@ -248,7 +370,7 @@ class BookStoreChatbot:
 """
         else:
             session["pending_order"] = order_info
-            return self._generate_order_confirmation_message(order_info)
+            return self._reserve_and_confirm(order_info, session_id)
         
   def _extract_book_title_from_order(self, user_message):
       message_lower = user_message.lower()
@@ -278,9 +400,9 @@ class BookStoreChatbot:
     if book_info['stock'] <= 0:
         return f"Xin lỗi, sách '{book_info['title']}' hiện đã hết hàng."
     
-    quantity = self._extract_quantity(user_message)
+    quantity = extract_quantity(user_message)
     
-    customer_info = self._extract_customer_info(user_message)
+    customer_info = extract_customer_info(user_message)
     
     order_info = {
         'book_title': book_info['title'],
@@ -314,7 +436,7 @@ class BookStoreChatbot:
         return response
     else:
         self.conversation_state[session_id]["pending_order"] = order_info
-        return self._generate_order_confirmation_message(order_info)
+        return self._reserve_and_confirm(order_info, session_id)
   
   def _check_missing_order_info(self, order_info):
     missing = []
@@ -339,6 +461,33 @@ class BookStoreChatbot:
     }
     return [field_names[field] for field in missing_fields]
 
+  def _reserve_and_confirm(self, order_info, session_id):
+    # Giữ hàng trong lúc chờ khách xác nhận để session khác không mua mất
+    try:
+        order_info['reservation_id'] = self.rag_system.db.reserve_stock(
+            session_id, order_info['book_id'], order_info['quantity']
+        )
+    except OutOfStockError as e:
+        return self._out_of_stock_message(order_info, e)
+    
+    return self._generate_order_confirmation_message(order_info)
+
+  def _out_of_stock_message(self, order_info, error):
+    title = order_info['book_info']['title']
+    if error.available <= 0:
+        return f"Xin lỗi, sách '{title}' hiện đã hết hàng. Trả lời 'hủy' để hủy đơn hàng."
+    return (f"Xin lỗi, sách '{title}' chỉ còn {error.available} quyển. "
+            f"Vui lòng cho biết số lượng mới (ví dụ: 'Số lượng: {error.available}') hoặc trả lời 'hủy'.")
+
+  def _release_pending_order(self, session):
+    pending_order = session.get("pending_order") or {}
+    try:
+        self.rag_system.db.release_reservation(pending_order.get('reservation_id'))
+    except Exception as e:
+        # Phần giữ hàng sẽ tự hết hạn, không chặn luồng hủy đơn
+        self.logger.warning(f"Không thể bỏ giữ hàng: {e}")
+    session["pending_order"] = None
+
   def _generate_order_confirmation_message(self, order_info):
     total_price = order_info['book_info']['price'] * order_info['quantity']
     
@@ -358,134 +507,6 @@ class BookStoreChatbot:
 - Trả lời 'hủy' để hủy đơn hàng
 """
 
-  def _extract_quantity(self, user_message):
-    message_lower = user_message.lower()
-    
-    # Từ khóa số lượng bằng chữ
-    quantity_words = {
-        'một': 1, 'hai': 2, 'ba': 3, 'bốn': 4, 'năm': 5,
-        'sáu': 6, 'bảy': 7, 'tám': 8, 'chín': 9, 'mười': 10
-    }
-    
-    for word, num in quantity_words.items():
-        if word in message_lower:
-            return num
-    
-    quantity_patterns = [
-        r'số\s*lượng\s*:\s*(\d+)',  
-        r'số\s*lượng\s*:\s*(\d+)',  
-        r'số\s*lượng\s*:\s*(\d+)',  
-        r'số\s*lượng\s+(\d+)',      
-        r'quantity\s*:\s*(\d+)',     
-        r'qty\s*:\s*(\d+)',          
-        r'(\d+)\s*quyển',
-        r'(\d+)\s*cuốn',
-        r'mua\s*(\d+)',
-        r'đặt\s*(\d+)'
-    ]
-    
-    for pattern in quantity_patterns:
-        try:
-            matches = re.finditer(pattern, message_lower)
-            for match in matches:
-                quantity = int(match.group(1))
-                if 1 <= quantity <= 100:
-                    return quantity
-        except:
-            continue
-    
-    if any(word in message_lower for word in ['số lượng', 'quantity', 'qty', 'quyển', 'cuốn']):
-        numbers = re.findall(r'\b\d+\b', message_lower)
-        for num_str in numbers:
-            try:
-                quantity = int(num_str)
-                if 1 <= quantity <= 100:
-                    return quantity
-            except:
-                continue
-    
-    return 0  
-
-  def _extract_customer_info(self, user_message):
-    customer_info = {
-        'customer_name': None,
-        'phone': None,
-        'address': None
-    }
-    
-    clean_message = re.sub(r'\s+', '', user_message.strip())
-    if re.fullmatch(r'(\+?[0-9]{10,12})', clean_message):
-        customer_info['phone'] = clean_message
-        return customer_info
-    
-    phone_patterns = [
-        r'(?:sdt|phone|điện\s*thoại|số|tel)[\s:\-]*(\+?[0-9\s\-]{10,12})',
-        r'(?:sdt|phone|số)[\s:\-]*là[\s:\-]*(\+?[0-9\s\-]{10,12})',
-        r'(?:sdt|phone|số)[\s:\-]*của\s*tôi[\s:\-]*(\+?[0-9\s\-]{10,12})',
-        r'(?:sdt|phone|số)[\s:\-]*của\s*tôi[\s:\-]*là[\s:\-]*(\+?[0-9\s\-]{10,12})',
-        r'(\+?0?[0-9]{9,11})' 
-    ]
-    
-    for pattern in phone_patterns:
-        matches = re.finditer(pattern, user_message, re.IGNORECASE)
-        for match in matches:
-            phone = re.sub(r'[\s\-]+', '', match.group(1))
-            if 10 <= len(phone) <= 12:
-                customer_info['phone'] = phone
-                break
-        if customer_info['phone']:
-            break
-    
-    name_patterns = [
-        r'tên[\s:\-]*([a-zA-ZÀ-ỹ\s]{2,})',
-        r'tôi\s*tên\s*là[\s:\-]*([a-zA-ZÀ-ỹ\s]{2,})',
-        r'tên[\s:\-]*tôi[\s:\-]*là[\s:\-]*([a-zA-ZÀ-ỹ\s]{2,})',
-        r'name[\s:\-]*([a-zA-ZÀ-ỹ\s]{2,})'
-    ]
-    
-    for pattern in name_patterns:
-        matches = re.finditer(pattern, user_message, re.IGNORECASE)
-        for match in matches:
-            name = match.group(1).strip()
-            if len(name.split()) >= 1:
-                customer_info['customer_name'] = name
-                break
-        if customer_info['customer_name']:
-            break
-    
-    address_patterns = [
-        r'địa\s*chỉ[\s:\-]*(.+?)(?=\s*(?:sdt|phone|tên|name|$))',
-        r'address[\s:\-]*(.+?)(?=\s*(?:sdt|phone|tên|name|$))',
-        r'địa\s*chỉ[\s:\-]*giao\s*hàng[\s:\-]*(.+?)(?=\s*(?:sdt|phone|tên|name|$))'
-    ]
-    
-    for pattern in address_patterns:
-        matches = re.finditer(pattern, user_message, re.IGNORECASE)
-        for match in matches:
-            address = match.group(1).strip()
-            if len(address) > 5:
-                customer_info['address'] = address
-                break
-        if customer_info['address']:
-            break
-    
-    form_patterns = [
-        r'tên[\s:\-]*([^,]+?)(?:\s*[,]|$)',
-        r'sđt[\s:\-]*([^,]+?)(?:\s*[,]|$)',
-        r'địa\s*chỉ[\s:\-]*([^,]+?)(?:\s*[,]|$)'
-    ]
-    
-    if not customer_info['customer_name']:
-        for pattern in form_patterns:
-            match = re.search(pattern, user_message, re.IGNORECASE)
-            if match:
-                value = match.group(1).strip()
-                if 'tên' in pattern and len(value) > 1:
-                    customer_info['customer_name'] = value
-                    break
-    
-    return customer_info
-  
   def _handle_order_confirmation(self, user_message: str, session_id: str) -> str:
     session = self.conversation_state[session_id]
     pending_order = session["pending_order"]
@@ -507,7 +528,8 @@ class BookStoreChatbot:
                 phone=pending_order['phone'],
                 address=pending_order['address'],
                 book_id=pending_order['book_id'],
-                quantity=pending_order['quantity']
+                quantity=pending_order['quantity'],
+                reservation_id=pending_order.get('reservation_id')
             )
             
             session["pending_order"] = None
@@ -524,18 +546,21 @@ Chúng tôi sẽ liên hệ với bạn trong vòng 24h để xác nhận và gi
 
 Cảm ơn bạn đã mua sắm tại BookStore!
 """
+        except OutOfStockError as e:
+            # Giữ đơn lại để khách có thể giảm số lượng
+            return self._out_of_stock_message(pending_order, e)
         except Exception as e:
-            session["pending_order"] = None
+            self._release_pending_order(session)
             return f"Có lỗi xảy ra khi tạo đơn hàng: {e}. Vui lòng thử lại."
     
     # Xử lý hủy đơn hàng
     elif any(word in message_lower for word in ['hủy', 'cancel', 'không', 'no', 'thôi']):
-        session["pending_order"] = None
+        self._release_pending_order(session)
         return "Đã hủy đơn hàng. Bạn có cần hỗ trợ gì khác không?"
     
     else:
-        updated_info = self._extract_customer_info(user_message)
-        quantity = self._extract_quantity(user_message)
+        updated_info = extract_customer_info(user_message)
+        quantity = extract_quantity(user_message)
         
         for key, value in updated_info.items():
             if value:
@@ -560,7 +585,7 @@ Thông tin hiện tại:
 **VẪN THIẾU:** {', '.join(missing_text)}
 """
         else:
-            return self._generate_order_confirmation_message(pending_order)
+            return self._reserve_and_confirm(pending_order, session_id)
 
   def _handle_order_edit(self, message_lower, session_id):
     session = self.conversation_state[session_id]
@@ -592,11 +617,16 @@ Thông tin hiện tại:
     
     return f"Vui lòng cung cấp {' và '.join(fields_text)} mới. Ví dụ: 'Tên: Nguyễn Văn A, SĐT: 0123456789'"
   
-  def _handle_general(self, user_message, session_id):
+  def _handle_general(self, user_message, session_id, on_token = None):
       try:
+          if on_token:
+              return self._collect_stream(self.llm_handler.stream_general_response(user_message), on_token)
           return self.llm_handler.generate_general_response(user_message)
       except:
-          return """
+          return self._handle_general_fallback()
+  
+  def _handle_general_fallback(self):
+      return """
 Xin chào! Tôi là trợ lý BookStore. Tôi có thể giúp bạn:
 
 **Tìm kiếm sách:** "Tìm sách về lập trình"
@@ -606,8 +636,34 @@ Xin chào! Tôi là trợ lý BookStore. Tôi có thể giúp bạn:
 Bạn cần tôi hỗ trợ gì?
 """
   
+  async def _ahandle_general(self, user_message, session_id, on_token = None):
+      try:
+          if on_token:
+              return await self._acollect_stream(self.llm_handler.astream_general_response(user_message), on_token)
+          return await self.llm_handler.agenerate_general_response(user_message)
+      except:
+          return self._handle_general_fallback()
+  
+  def readiness(self):
+      return {
+          "database": True,
+          "embeddings": self.rag_system.embeddings_ready.is_set(),
+          "embedding_model": self.rag_system.embedding_handler.model_loaded,
+          "llm": self.llm_handler.ready.is_set(),
+          "llm_available": self.llm_handler.available
+      }
+  
+  def wait_until_ready(self, timeout = None):
+      embeddings_ready = self.rag_system.embeddings_ready.wait(timeout)
+      llm_ready = self.llm_handler.ready.wait(timeout)
+      return embeddings_ready and llm_ready
+  
   def get_system_stats(self):
-      return self.rag_system.get_statistics()
+      stats = self.rag_system.get_statistics()
+      stats["llm_scheduler"] = self.llm_handler.scheduler.stats()
+      stats["llm_breaker"] = self.llm_handler.breaker_stats()
+      stats["response_cache"] = self.llm_handler.response_cache.stats()
+      return stats
   
 #   def get_conversation_history(self, session_id):
 #       session = self.conversation_state.get(session_id, {})
@@ -633,5 +689,16 @@ if __name__ == "__main__":
           print(f"Thống kê: {stats}")
           continue
       
-      response = chatbot.process_message(user_input)
-      print(f"Bot: {response}\n")
\ No newline at end of file
+      streamed = []
+      
+      def print_token(token):
+          if not streamed:
+              print("Bot: ", end="", flush=True)
+          streamed.append(token)
+          print(token, end="", flush=True)
+      
+      response = chatbot.process_message(user_input, on_token=print_token)
+      if streamed:
+          print("\n")
+      else:
+          print(f"Bot: {response}\n")
\ No newline at end of file
@@ -0,0 +1,131 @@
+import os
+import sys
+import time
+import threading
+from contextlib import contextmanager
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config
+import logging
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class _Call:
+    def __init__(self):
+        self.started = time.monotonic()
+
+    def start(self):
+        # Gọi ngay trước khi gửi yêu cầu tới model để thời gian chờ hàng đợi không bị tính là model chậm
+        self.started = time.monotonic()
+
+
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold=config.LLM_BREAKER_FAILURE_THRESHOLD,
+                 reset_timeout=config.LLM_BREAKER_RESET_TIMEOUT, ignored_exceptions=()):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        # Lỗi không phải do server (ví dụ session bị giới hạn tần suất) không tính vào breaker
+        self.ignored_exceptions = tuple(ignored_exceptions)
+
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+
+        self._rejected = 0
+        self._slow_calls = 0
+        self._failed_calls = 0
+        self._trips = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state
+
+    @contextmanager
+    def guard(self, slow_after=None):
+        probe = self._acquire()
+        call = _Call()
+        try:
+            yield call
+        except self.ignored_exceptions:
+            self._finish(probe, None)
+            raise
+        except Exception:
+            with self._lock:
+                self._failed_calls += 1
+            self._finish(probe, False)
+            raise
+        except BaseException:
+            # Hủy từ phía người gọi (ngắt kết nối, đóng generator) không phản ánh tình trạng model
+            self._finish(probe, None)
+            raise
+        else:
+            slow = slow_after is not None and time.monotonic() - call.started > slow_after
+            if slow:
+                with self._lock:
+                    self._slow_calls += 1
+            self._finish(probe, not slow)
+
+    def _acquire(self):
+        with self._lock:
+            if self._state == OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    self._rejected += 1
+                    raise CircuitOpenError(f"Breaker {self.name} đang mở")
+                self._state = HALF_OPEN
+                logger.info(f"Breaker {self.name} chuyển sang half-open, thử lại một lời gọi")
+
+            if self._state == HALF_OPEN:
+                # Chỉ một lời gọi thăm dò tại một thời điểm, các lời gọi khác dùng dự phòng
+                if self._probing:
+                    self._rejected += 1
+                    raise CircuitOpenError(f"Breaker {self.name} đang thăm dò")
+                self._probing = True
+                return True
+            return False
+
+    def _finish(self, probe, success):
+        with self._lock:
+            if probe:
+                self._probing = False
+
+            if success is None:
+                # Lời gọi không cho kết quả: nếu là thăm dò thì để lời gọi sau thăm dò lại
+                return
+
+            if success:
+                if self._state != CLOSED:
+                    logger.info(f"Breaker {self.name} đóng lại, model đã phản hồi bình thường")
+                self._state = CLOSED
+                self._failures = 0
+                return
+
+            self._failures += 1
+            if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != OPEN:
+                    self._trips += 1
+                    logger.warning(f"Breaker {self.name} mở sau {self._failures} lời gọi lỗi/chậm liên tiếp")
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "state": self._state,
+                "consecutive_failures": self._failures,
+                "failed_calls": self._failed_calls,
+                "slow_calls": self._slow_calls,
+                "rejected": self._rejected,
+                "trips": self._trips
+            }
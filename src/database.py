@@ -1,17 +1,174 @@
 import os
 import sqlite3
 import json
+import re
+import time
+import random
+import threading
+from contextlib import contextmanager
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Pragma áp dụng cho mỗi kết nối khi được mở lần đầu
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -16000,       # ~16MB page cache cho mỗi kết nối
+    "mmap_size": 268435456,     # 256MB
+    "temp_store": "MEMORY",
+    "busy_timeout": 5000,
+}
+STATEMENT_CACHE_SIZE = 128
+
+# Trọng số BM25 cho các cột (title, author, description) của books_fts
+FTS_COLUMN_WEIGHTS = (10.0, 5.0, 1.0)
+
+# Thử lại giao dịch ghi khi SQLite báo bận, với backoff ngẫu nhiên để tránh lock convoy
+BUSY_RETRY_ATTEMPTS = 5
+BUSY_RETRY_BASE_DELAY = 0.02
+# Thời gian giữ hàng cho đơn đang chờ xác nhận (giây)
+RESERVATION_TTL = 600
+
+
+class OutOfStockError(Exception):
+    def __init__(self, book_id, requested, available):
+        super().__init__(f"Sách {book_id} chỉ còn {available} quyển, không đủ {requested} quyển")
+        self.book_id = book_id
+        self.requested = requested
+        self.available = available
+
 
 class BookStoreDB:
-    def __init__(self, db_path="data/books.db"):
+    def __init__(self, db_path="data/books.db", pragmas=None, fold_diacritics=True, seed=True):
         self.db_path = db_path
+        # Database rỗng được nạp sách mẫu, trừ khi sắp nhập danh mục thật
+        self.seed = seed
+        self.pragmas = {**SQLITE_PRAGMAS, **(pragmas or {})}
+        # Bỏ dấu tiếng Việt khi đánh chỉ mục: "nha gia kim" khớp "Nhà Giả Kim"
+        self.fold_diacritics = fold_diacritics
+        self.fts_enabled = False
         os.makedirs(os.path.dirname(db_path), exist_ok=True)
+
+        # Mỗi thread giữ một kết nối dùng lâu dài, tránh mở/đóng cho từng truy vấn
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        # Callback nhận book_id mỗi khi tồn kho thay đổi
+        self._stock_listeners = []
+
         self.init_database()
-    
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.db_path,
+            check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE
+        )
+        for name, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {name} = {value}")
+        return conn
+
+    def get_connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    @contextmanager
+    def transaction(self, immediate=False):
+        conn = self.get_connection()
+        if immediate:
+            # Giữ khóa ghi ngay từ đầu, tránh nâng cấp khóa giữa chừng gây SQLITE_BUSY
+            conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn.cursor()
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    def _write(self, work, attempts=BUSY_RETRY_ATTEMPTS):
+        for attempt in range(attempts):
+            try:
+                with self.transaction(immediate=True) as cursor:
+                    return work(cursor)
+            except sqlite3.OperationalError as e:
+                message = str(e)
+                if attempt == attempts - 1 or ("locked" not in message and "busy" not in message):
+                    raise
+                time.sleep(BUSY_RETRY_BASE_DELAY * (2 ** attempt) * random.uniform(0.5, 1.5))
+
+    def add_stock_listener(self, listener):
+        self._stock_listeners.append(listener)
+
+    def _notify_stock_changed(self, book_id):
+        for listener in self._stock_listeners:
+            listener(book_id)
+
+    def close(self):
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        self._local = threading.local()
+
     def init_database(self):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        self.migrate()
+
+        try:
+            with self.transaction() as cursor:
+                self._create_fts_index(cursor)
+            self.fts_enabled = True
+        except sqlite3.OperationalError:
+            # SQLite không có FTS5, dùng LIKE
+            self.fts_enabled = False
+
+        if self.seed and self.count_books() == 0:
+            self.insert_data()
 
+    def _migrations(self):
+        # Phiên bản schema là vị trí trong danh sách, chỉ thêm migration mới vào cuối
+        return [
+            self._create_schema,
+            self._create_reservations,
+            self._create_indexes,
+            self._create_order_keyset_index,
+        ]
+
+    def schema_version(self):
+        return self.get_connection().execute('PRAGMA user_version').fetchone()[0]
+
+    def migrate(self):
+        migrations = self._migrations()
+        while True:
+            # Mỗi migration là một giao dịch riêng, đọc lại phiên bản sau khi giữ khóa ghi
+            # để nhiều tiến trình khởi động cùng lúc không chạy trùng
+            with self.transaction(immediate=True) as cursor:
+                version = cursor.execute('PRAGMA user_version').fetchone()[0]
+                if version >= len(migrations):
+                    return version
+
+                migration = migrations[version]
+                migration(cursor)
+                cursor.execute(f'PRAGMA user_version = {version + 1}')
+            logger.info(f"Đã nâng schema lên phiên bản {version + 1} ({migration.__name__})")
+
+    def _create_order_keyset_index(self, cursor):
+        # Thêm order_id vào cuối chỉ mục để phân trang theo (created_at, order_id) không cần sắp xếp
+        cursor.execute('DROP INDEX IF EXISTS idx_orders_phone_created_at')
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_orders_phone_created_at_id
+        ON orders (phone, created_at DESC, order_id DESC)
+''')
+
+    def _create_schema(self, cursor):
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS books (
                        book_id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -37,12 +194,104 @@ class BookStoreDB:
                        FOREIGN KEY (book_id) REFERENCES books (book_id)
                        )
 ''')
-        conn.commit()
-        conn.close()
 
-        if self.count_books() == 0:
-            self.insert_data()
+    def _create_reservations(self, cursor):
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stock_reservations (
+                       reservation_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                       session_id TEXT NOT NULL,
+                       book_id INTEGER NOT NULL,
+                       quantity INTEGER NOT NULL,
+                       expires_at REAL NOT NULL,
+                       UNIQUE (session_id, book_id),
+                       FOREIGN KEY (book_id) REFERENCES books (book_id)
+                       )
+''')
+
+    def _create_indexes(self, cursor):
+        # Tra cứu đơn theo SĐT đi thẳng theo chỉ mục, đã sắp sẵn theo thời gian
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_orders_phone_created_at
+        ON orders (phone, created_at DESC)
+''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_orders_book_id ON orders (book_id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_books_category ON books (category)')
+        # Tổng hàng đang giữ của một cuốn được tính trong mỗi lần đặt hàng
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_stock_reservations_book_expires
+        ON stock_reservations (book_id, expires_at)
+''')
+        cursor.execute('ANALYZE')
     
+    def _fts_tokenizer(self):
+        return "unicode61 remove_diacritics 2" if self.fold_diacritics else "unicode61 remove_diacritics 0"
+
+    def _fts_column(self, expr):
+        # unicode61 không tách được "đ" thành "d", nên thay thủ công
+        if self.fold_diacritics:
+            return f"replace(replace({expr}, 'đ', 'd'), 'Đ', 'D')"
+        return expr
+
+    def _create_fts_index(self, cursor):
+        tokenizer = self._fts_tokenizer()
+        row = cursor.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'books_fts'"
+        ).fetchone()
+
+        if row and tokenizer in row[0]:
+            return
+
+        # Chưa có chỉ mục hoặc đổi tokenizer: tạo lại từ bảng books
+        cursor.execute("DROP TRIGGER IF EXISTS books_fts_ai")
+        cursor.execute("DROP TRIGGER IF EXISTS books_fts_ad")
+        cursor.execute("DROP TRIGGER IF EXISTS books_fts_au")
+        cursor.execute("DROP TABLE IF EXISTS books_fts")
+
+        cursor.execute(f'''
+        CREATE VIRTUAL TABLE books_fts USING fts5(
+                       title, author, description,
+                       tokenize = '{tokenizer}'
+                       )
+''')
+
+        title = self._fts_column("new.title")
+        author = self._fts_column("new.author")
+        description = self._fts_column("coalesce(new.description, '')")
+
+        cursor.execute(f'''
+        CREATE TRIGGER books_fts_ai AFTER INSERT ON books BEGIN
+            INSERT INTO books_fts (rowid, title, author, description)
+            VALUES (new.book_id, {title}, {author}, {description});
+        END
+''')
+        cursor.execute('''
+        CREATE TRIGGER books_fts_ad AFTER DELETE ON books BEGIN
+            DELETE FROM books_fts WHERE rowid = old.book_id;
+        END
+''')
+        # Chỉ cập nhật chỉ mục khi cột văn bản thay đổi, không phải mỗi lần trừ tồn kho
+        cursor.execute(f'''
+        CREATE TRIGGER books_fts_au AFTER UPDATE OF title, author, description ON books BEGIN
+            UPDATE books_fts SET title = {title}, author = {author}, description = {description}
+            WHERE rowid = new.book_id;
+        END
+''')
+
+        cursor.execute(f'''
+            INSERT INTO books_fts (rowid, title, author, description)
+            SELECT book_id, {self._fts_column("title")}, {self._fts_column("author")},
+                   {self._fts_column("coalesce(description, '')")}
+            FROM books
+''')
+
+    def _build_fts_query(self, query):
+        if self.fold_diacritics:
+            query = query.replace('đ', 'd').replace('Đ', 'D')
+
+        # Mỗi từ khớp theo tiền tố, các từ nối bằng AND
+        tokens = re.findall(r'\w+', query)
+        return ' '.join(f'"{token}"*' for token in tokens)
+
     def insert_data(self):
         books_data = [
             {
@@ -91,77 +340,201 @@ class BookStoreDB:
           }
         ]
 
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        self.insert_books(books_data)
 
-        for book in books_data:
-            cursor.execute('''
+    def insert_books(self, books):
+        rows = [(book["title"], book["author"], book["price"],
+                 book["stock"], book["category"], book.get("description")) for book in books]
+
+        def work(cursor):
+            last_id = cursor.execute('SELECT COALESCE(MAX(book_id), 0) FROM books').fetchone()[0]
+            cursor.executemany('''
                     INSERT INTO books (title, author, price, stock, category, description)
                     VALUES(?, ?, ? ,? ,?, ?)
-        ''', (book["title"], book["author"], book["price"], 
-               book["stock"], book["category"], book["description"]))
-        
-        conn.commit()
-        conn.close()
+        ''', rows)
+            # Đang giữ khóa ghi nên các book_id mới là các id lớn hơn id cuối trước khi chèn
+            cursor.execute('SELECT * FROM books WHERE book_id > ? ORDER BY book_id', (last_id,))
+            return [self._row_to_dict(row) for row in cursor.fetchall()]
+
+        return self._write(work)
     
-    def search_books(self, query=None, category=None):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    def _filter_clauses(self, category=None, min_price=None, max_price=None, in_stock=False):
+        clauses, params = [], []
+        if category:
+            clauses.append("b.category = ?")
+            params.append(category)
+        if min_price is not None:
+            clauses.append("b.price >= ?")
+            params.append(min_price)
+        if max_price is not None:
+            clauses.append("b.price <= ?")
+            params.append(max_price)
+        if in_stock:
+            clauses.append("b.stock > 0")
+        return clauses, params
 
-        if query:
-            cursor.execute('''
-                SELECT * FROM books 
-                WHERE title LIKE ? OR author LIKE ? OR description LIKE ?
-        ''', (f'%{query}%', f'%{query}%', f'%{query}%'))
-        elif category: 
-            cursor.execute('SELECT * FROM books WHERE category = ?', (category, ))
+    def search_books(self, query=None, category=None, limit=None, min_price=None, max_price=None, in_stock=False):
+        cursor = self.get_connection().cursor()
+        limit = -1 if limit is None else limit
+
+        # Bộ lọc metadata nằm trong cùng câu truy vấn, không lọc lại trong Python
+        clauses, params = self._filter_clauses(category, min_price, max_price, in_stock)
+        filters = ''.join(f' AND {clause}' for clause in clauses)
+
+        fts_query = self._build_fts_query(query) if query and self.fts_enabled else None
+
+        if fts_query:
+            cursor.execute(f'''
+                SELECT b.* FROM books_fts f
+                JOIN books b ON b.book_id = f.rowid
+                WHERE books_fts MATCH ?{filters}
+                ORDER BY bm25(books_fts, ?, ?, ?)
+                LIMIT ?
+        ''', (fts_query, *params, *FTS_COLUMN_WEIGHTS, limit))
+        elif query:
+            cursor.execute(f'''
+                SELECT b.* FROM books b
+                WHERE (b.title LIKE ? OR b.author LIKE ? OR b.description LIKE ?){filters}
+                LIMIT ?
+        ''', (f'%{query}%', f'%{query}%', f'%{query}%', *params, limit))
         else:
-            cursor.execute('SELECT * FROM books')
+            cursor.execute(f'SELECT b.* FROM books b WHERE 1 = 1{filters} LIMIT ?', (*params, limit))
         
         books = cursor.fetchall()
-        conn.close()
 
         return [self._row_to_dict(book) for book in books]
     
     def get_book_by_id(self, book_id):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM books WHERE book_id = ?', (book_id, ))
-        book = cursor. fetchone()
-        conn.close()
+        cursor = self.get_connection().execute('SELECT * FROM books WHERE book_id = ?', (book_id, ))
+        book = cursor.fetchone()
         
         return self._row_to_dict(book) if book else None
     
-    def create_order(self, customer_name, phone, address, book_id, quantity):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
+    def get_books_by_ids(self, book_ids):
+        # Trả về theo đúng thứ tự book_ids, bỏ qua id không tồn tại
+        book_ids = list(dict.fromkeys(book_ids))
+        books = {}
+        conn = self.get_connection()
+
+        for start in range(0, len(book_ids), 500):
+            chunk = book_ids[start:start + 500]
+            placeholders = ', '.join('?' * len(chunk))
+            cursor = conn.execute(f'SELECT * FROM books WHERE book_id IN ({placeholders})', chunk)
+            for row in cursor.fetchall():
+                books[row[0]] = self._row_to_dict(row)
+
+        return [books[book_id] for book_id in book_ids if book_id in books]
+
+    def has_books(self):
+        return self.get_connection().execute('SELECT 1 FROM books LIMIT 1').fetchone() is not None
+
+    def _reserved_stock(self, cursor, book_id, now, exclude_reservation=None):
+        row = cursor.execute('''
+            SELECT COALESCE(SUM(quantity), 0) FROM stock_reservations
+            WHERE book_id = ? AND expires_at > ? AND reservation_id IS NOT ?
+        ''', (book_id, now, exclude_reservation)).fetchone()
+        return row[0]
+
+    def _available_stock(self, cursor, book_id, now, exclude_reservation=None):
+        row = cursor.execute('SELECT stock FROM books WHERE book_id = ?', (book_id,)).fetchone()
+        if not row:
+            return 0
+        return row[0] - self._reserved_stock(cursor, book_id, now, exclude_reservation)
+
+    def reserve_stock(self, session_id, book_id, quantity, ttl=RESERVATION_TTL):
+        def work(cursor):
+            now = time.time()
+            cursor.execute('DELETE FROM stock_reservations WHERE expires_at <= ?', (now,))
+            existing = cursor.execute(
+                'SELECT reservation_id FROM stock_reservations WHERE session_id = ? AND book_id = ?',
+                (session_id, book_id)
+            ).fetchone()
+            existing_id = existing[0] if existing else None
+
+            # Mỗi session chỉ giữ một phần hàng cho mỗi cuốn, đặt lại sẽ thay thế phần cũ
+            available = self._available_stock(cursor, book_id, now, existing_id)
+            if available < quantity:
+                raise OutOfStockError(book_id, quantity, max(available, 0))
+
+            cursor.execute('''
+                INSERT INTO stock_reservations (session_id, book_id, quantity, expires_at)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (session_id, book_id)
+                DO UPDATE SET quantity = excluded.quantity, expires_at = excluded.expires_at
+            ''', (session_id, book_id, quantity, now + ttl))
+            return existing_id or cursor.lastrowid
+
+        return self._write(work)
+
+    def release_reservation(self, reservation_id):
+        if reservation_id is None:
+            return
+        self._write(lambda cursor: cursor.execute(
+            'DELETE FROM stock_reservations WHERE reservation_id = ?', (reservation_id,)
+        ))
+
+    def create_order(self, customer_name, phone, address, book_id, quantity, reservation_id=None):
+        def work(cursor):
+            now = time.time()
+            if reservation_id is not None:
+                cursor.execute('DELETE FROM stock_reservations WHERE reservation_id = ?', (reservation_id,))
+
+            # Trừ kho có điều kiện trong cùng một câu lệnh, tính cả hàng đang được giữ cho session khác
+            cursor.execute('''
+            UPDATE books
+            SET stock = stock - ?
+            WHERE book_id = ?
+              AND stock - (SELECT COALESCE(SUM(quantity), 0) FROM stock_reservations
+                           WHERE book_id = ? AND expires_at > ?) >= ?
+        ''', (quantity, book_id, book_id, now, quantity))
+
+            if cursor.rowcount == 0:
+                raise OutOfStockError(book_id, quantity, max(self._available_stock(cursor, book_id, now), 0))
+
+            cursor.execute('''
                 INSERT INTO orders (customer_name, phone, address, book_id, quantity)
                 VALUES (?, ?, ?, ?, ?)
-        ''', (customer_name, phone, address, book_id, quantity))
+            ''', (customer_name, phone, address, book_id, quantity))
+            return cursor.lastrowid
 
-        order_id = cursor.lastrowid
-
-        cursor.execute('''
-        UPDATE books 
-        SET stock = stock - ? 
-        WHERE book_id = ?
-    ''', (quantity, book_id))
-        
-        conn.commit()
-        conn.close()
+        order_id = self._write(work)
+        self._notify_stock_changed(book_id)
 
         return order_id
     
     def count_books(self):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('SELECT COUNT(*) FROM books')
+        cursor = self.get_connection().execute('SELECT COUNT(*) FROM books')
         count = cursor.fetchone()[0]
-        conn.close()
 
         return count
+
+    def count_books_by_category(self):
+        cursor = self.get_connection().execute(
+            'SELECT category, COUNT(*) FROM books GROUP BY category ORDER BY category'
+        )
+        return dict(cursor.fetchall())
+
+    def get_books_page(self, after_id=0, limit=100, category=None):
+        # Phân trang theo khóa: WHERE book_id > id cuối của trang trước, không dùng OFFSET
+        if category:
+            cursor = self.get_connection().execute(
+                'SELECT * FROM books WHERE category = ? AND book_id > ? ORDER BY book_id LIMIT ?',
+                (category, after_id, limit)
+            )
+        else:
+            cursor = self.get_connection().execute(
+                'SELECT * FROM books WHERE book_id > ? ORDER BY book_id LIMIT ?',
+                (after_id, limit)
+            )
+        books = [self._row_to_dict(row) for row in cursor.fetchall()]
+        next_id = books[-1]['book_id'] if len(books) == limit else None
+        return books, next_id
+
+    def iter_books(self, batch_size=1000, category=None):
+        after_id = 0
+        while after_id is not None:
+            books, after_id = self.get_books_page(after_id, batch_size, category)
+            yield from books
     
     def _row_to_dict(self, row):
         if not row:
@@ -177,34 +550,54 @@ class BookStoreDB:
             'description': row[6] if len(row) > 6 else ''
         }
     
-    def get_orders_by_phone(self, phone):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT o.*, b.title, b.price 
-            FROM orders o 
-            JOIN books b ON o.book_id = b.book_id 
-            WHERE o.phone = ?
-            ORDER BY o.created_at DESC
-        ''', (phone,))
-        
-        orders = cursor.fetchall()
-        conn.close()
-        
-        result = []
-        for order in orders:
-            result.append({
-                'order_id': order[0],
-                'customer_name': order[1],
-                'phone': order[2],
-                'address': order[3],
-                'book_id': order[4],
-                'quantity': order[5],
-                'status': order[6],
-                'created_at': order[7],
-                'book_title': order[8],
-                'price_per_book': order[9] 
-            })
-        
-        return result
\ No newline at end of file
+    def get_orders_by_phone(self, phone, limit=None):
+        orders, _ = self.get_orders_page(phone, limit=-1 if limit is None else limit)
+        return orders
+
+    def get_orders_page(self, phone, after=None, limit=50):
+        # after là (created_at, order_id) của đơn cuối trang trước; đơn mới nhất trước
+        if after:
+            cursor = self.get_connection().execute('''
+                SELECT o.*, b.title, b.price 
+                FROM orders o 
+                JOIN books b ON o.book_id = b.book_id 
+                WHERE o.phone = ? AND (o.created_at, o.order_id) < (?, ?)
+                ORDER BY o.created_at DESC, o.order_id DESC
+                LIMIT ?
+            ''', (phone, after[0], after[1], limit))
+        else:
+            cursor = self.get_connection().execute('''
+                SELECT o.*, b.title, b.price 
+                FROM orders o 
+                JOIN books b ON o.book_id = b.book_id 
+                WHERE o.phone = ?
+                ORDER BY o.created_at DESC, o.order_id DESC
+                LIMIT ?
+            ''', (phone, limit))
+
+        orders = [self._order_row_to_dict(order) for order in cursor.fetchall()]
+        next_after = None
+        if limit >= 0 and len(orders) == limit:
+            next_after = (orders[-1]['created_at'], orders[-1]['order_id'])
+        return orders, next_after
+
+    def iter_orders_by_phone(self, phone, batch_size=100):
+        orders, after = self.get_orders_page(phone, limit=batch_size)
+        yield from orders
+        while after is not None:
+            orders, after = self.get_orders_page(phone, after, batch_size)
+            yield from orders
+
+    def _order_row_to_dict(self, order):
+        return {
+            'order_id': order[0],
+            'customer_name': order[1],
+            'phone': order[2],
+            'address': order[3],
+            'book_id': order[4],
+            'quantity': order[5],
+            'status': order[6],
+            'created_at': order[7],
+            'book_title': order[8],
+            'price_per_book': order[9] 
+        }
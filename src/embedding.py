@@ -1,36 +1,226 @@
 import os
-from sentence_transformers import SentenceTransformer
-import chromadb
-from chromadb.config import Settings
+import atexit
+import hashlib
+import re
+import shutil
+import sqlite3
+import threading
+import unicodedata
+from collections import OrderedDict
+from itertools import islice
+import numpy as np
 import json
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from config import EMBEDDING_MODEL
+from config import EMBEDDING_MODEL, EMBEDDING_BATCH_SIZE, EMBEDDING_PRECISION
+from config import QUERY_CACHE_SIZE, QUERY_CACHE_MAX_BYTES, QUERY_CACHE_PATH
 import logging
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Tăng khi cách tạo vector thay đổi để lần đồng bộ sau embed lại toàn bộ
+EMBEDDING_SCHEMA_VERSION = 2
+CHROMA_WRITE_BATCH_SIZE = 1000
+
+class QueryEmbeddingCache:
+    def __init__(self, max_entries=QUERY_CACHE_SIZE, max_bytes=QUERY_CACHE_MAX_BYTES, path=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.path = str(path) if path else None
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model_name, text):
+        normalized = " ".join(unicodedata.normalize("NFC", text).lower().split())
+        return f"{model_name}\x00{normalized}"
+
+    def get(self, key):
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return vector
+
+    def put(self, key, vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old.nbytes
+            self._entries[key] = vector
+            self._bytes += vector.nbytes
+
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.nbytes
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "entries": len(self._entries),
+                "bytes": self._bytes
+            }
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with np.load(self.path, allow_pickle=False) as data:
+                for key, vector in zip(data["keys"].tolist(), data["vectors"]):
+                    self.put(key, vector)
+            logger.info(f"Đã tải {len(self._entries)} vector truy vấn từ cache")
+        except Exception as e:
+            logger.warning(f"Không tải được cache vector truy vấn: {e}")
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            if not self._entries:
+                return
+            keys = np.array(list(self._entries.keys()))
+            vectors = np.stack(list(self._entries.values()))
+        try:
+            # np.savez tự thêm đuôi .npz nếu thiếu, nên ghi qua file object
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.savez(f, keys=keys, vectors=vectors)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logger.warning(f"Không lưu được cache vector truy vấn: {e}")
+
+
 class EmbeddingManager:
-    def __init__(self):
+    def __init__(self, batch_size=EMBEDDING_BATCH_SIZE, precision=EMBEDDING_PRECISION,
+                 query_cache_path=QUERY_CACHE_PATH):
         model_name = EMBEDDING_MODEL.split('/')[-1] if '/' in EMBEDDING_MODEL else EMBEDDING_MODEL
         self.model_name = model_name
-        logger.info(f"Loading embedding model: {self.model_name}")
+        self.batch_size = batch_size
+        self.precision = precision
 
+        self.query_cache = QueryEmbeddingCache(path=query_cache_path)
+        self.query_cache.load()
+        if self.query_cache.path:
+            atexit.register(self.query_cache.save)
+
+        # Model và Chroma chỉ được mở khi dùng lần đầu để khởi động nhanh
+        self._model = None
+        self._model_failed = False
+        self._model_lock = threading.Lock()
+
+        self.persist_path = "data/chromadb"
+        self._chroma_client = None
+        self._collection = None
+        self._chroma_lock = threading.RLock()
+
+    @property
+    def model(self):
+        if self._model is None and not self._model_failed:
+            with self._model_lock:
+                if self._model is None and not self._model_failed:
+                    self._model = self._load_model()
+                    self._model_failed = self._model is None
+        return self._model
+
+    @property
+    def model_loaded(self):
+        return self._model is not None
+
+    def _load_model(self):
+        logger.info(f"Loading embedding model: {self.model_name}")
         try:
-            self.model = SentenceTransformer(self.model_name)
+            from sentence_transformers import SentenceTransformer
+            model = self._apply_precision(SentenceTransformer(self.model_name))
             logger.info(f"Embedding model '{self.model_name}' đã tải.")
+            return model
         except Exception as e:
             logger.error(f"Thất bại khi tải embedding model '{self.model_name}': {e}")
-            self.model = None  
+            return None
+
+    @property
+    def chroma_client(self):
+        if self._chroma_client is None:
+            with self._chroma_lock:
+                if self._chroma_client is None:
+                    import chromadb
+                    self._chroma_client = chromadb.PersistentClient(path=self.persist_path)
+        return self._chroma_client
+
+    @property
+    def collection(self):
+        if self._collection is None:
+            with self._chroma_lock:
+                if self._collection is None:
+                    self._collection = self._get_collection()
+        return self._collection
 
-        self.chroma_client = chromadb.PersistentClient(path="data/chromadb")
-        self.collection = self.chroma_client.get_or_create_collection(
+    def warm_up(self):
+        self.collection
+        return self.model is not None
+
+    def _get_collection(self):
+        # Vector luôn được tính bằng self.model, không để Chroma tự tải model mặc định
+        return self.chroma_client.get_or_create_collection(
             name="books_collection",
-            metadata={"hnsw:space":"cosine"}
+            metadata={"hnsw:space": "cosine"},
+            embedding_function=None
         )
 
-        logger.info(f"Embedding model: {self.model_name} đã sẵn sàng")
+    def _apply_precision(self, model):
+        if self.precision == "float16":
+            if model.device.type == "cuda":
+                model.half()
+            else:
+                logger.warning("float16 chỉ hỗ trợ trên GPU, dùng float32")
+        elif self.precision == "int8":
+            import torch
+            model = torch.quantization.quantize_dynamic(
+                model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+        return model
+
+    def encode(self, texts):
+        if self.model is None:
+            raise RuntimeError(f"Embedding model '{self.model_name}' chưa được tải")
+
+        embeddings = self.model.encode(
+            texts,
+            batch_size=self.batch_size,
+            normalize_embeddings=True,
+            convert_to_numpy=True,
+            show_progress_bar=False
+        )
+        return embeddings.astype(np.float32).tolist()
+
+    def encode_query(self, query):
+        key = QueryEmbeddingCache.make_key(self.model_name, query)
+        vector = self.query_cache.get(key)
+        if vector is None:
+            vector = np.asarray(self.encode([query])[0], dtype=np.float32)
+            self.query_cache.put(key, vector)
+        return vector.tolist()
+
+    def _upsert(self, ids, documents, metadatas):
+        for start in range(0, len(ids), CHROMA_WRITE_BATCH_SIZE):
+            end = start + CHROMA_WRITE_BATCH_SIZE
+            self.collection.upsert(
+                ids=ids[start:end],
+                documents=documents[start:end],
+                embeddings=self.encode(documents[start:end]),
+                metadatas=metadatas[start:end]
+            )
 
     def create_book_embeddings(self, books):
         logger.info("Đang tạo embeddings cho sách...")
@@ -41,52 +231,140 @@ class EmbeddingManager:
         except Exception:
             logger.info("Không tồn tại collection để xóa.")
 
-        self.collection = self.chroma_client.get_or_create_collection(
-            name="books_collection",
-            metadata={"hnsw:space": "cosine"}
-        )
+        self._collection = self._get_collection()
+
+        documents = [self._book_document(book) for book in books]
+        metadatas = [self._book_metadata(book, doc) for book, doc in zip(books, documents)]
+        ids = [self._book_doc_id(book) for book in books]
+
+        # Thêm dữ liệu mới
+        if documents:
+            self._upsert(ids, documents, metadatas)
+            logger.info(f"Đang tạo embeddings cho {len(books)} sách.")
+        else:
+            logger.warning("Không sách nào cung cấp, collection rỗng.")
+
+        self._prune_orphan_segments()
+
+    def upsert_book_embeddings(self, books):
+        # Chỉ thêm/ghi đè các sách được truyền vào, không xóa sách khác như khi đồng bộ
+        documents = [self._book_document(book) for book in books]
+        metadatas = [self._book_metadata(book, doc) for book, doc in zip(books, documents)]
+        self._upsert([self._book_doc_id(book) for book in books], documents, metadatas)
+        return len(documents)
+
+    def sync_book_embeddings(self, books):
+        # Xử lý theo từng trang: chỉ giữ metadata/tài liệu của một trang và tập ID sách hiện có
+        summary = {"embedded": 0, "updated": 0, "removed": 0}
+        current_ids = set()
+        books = iter(books)
+        while True:
+            page = list(islice(books, self.batch_size))
+            if not page:
+                break
+            embedded, updated = self._sync_page(page)
+            summary["embedded"] += embedded
+            summary["updated"] += updated
+            current_ids.update(self._book_doc_id(book) for book in page)
+
+        removed_ids = self._stale_ids(current_ids)
+        for start in range(0, len(removed_ids), CHROMA_WRITE_BATCH_SIZE):
+            self.collection.delete(ids=removed_ids[start:start + CHROMA_WRITE_BATCH_SIZE])
+        summary["removed"] = len(removed_ids)
+
+        self._prune_orphan_segments()
 
-        documents = []
-        metadatas = []
-        ids = []
+        logger.info(f"Đồng bộ embeddings: {summary}")
+        return summary
 
-        for book in books:
-            text = f"""
+    def _sync_page(self, books):
+        ids = [self._book_doc_id(book) for book in books]
+        existing = self.collection.get(ids=ids, include=["metadatas"])
+        existing_metadatas = dict(zip(existing["ids"], existing["metadatas"]))
+
+        embed_ids, embed_documents, embed_metadatas = [], [], []
+        update_ids, update_metadatas = [], []
+
+        for doc_id, book in zip(ids, books):
+            document = self._book_document(book)
+            metadata = self._book_metadata(book, document)
+
+            old_metadata = existing_metadatas.get(doc_id)
+            if not old_metadata or old_metadata.get("content_hash") != metadata["content_hash"]:
+                embed_ids.append(doc_id)
+                embed_documents.append(document)
+                embed_metadatas.append(metadata)
+            elif old_metadata != metadata:
+                # Chỉ giá/tồn kho thay đổi: cập nhật metadata, không cần embed lại
+                update_ids.append(doc_id)
+                update_metadatas.append(metadata)
+
+        if embed_ids:
+            self._upsert(embed_ids, embed_documents, embed_metadatas)
+        if update_ids:
+            self.collection.update(ids=update_ids, metadatas=update_metadatas)
+        return len(embed_ids), len(update_ids)
+
+    def _stale_ids(self, current_ids):
+        # Duyệt ID trong Chroma theo trang, không lấy metadata; xóa sau khi duyệt xong để offset không bị lệch
+        stale_ids = []
+        offset = 0
+        while True:
+            page = self.collection.get(include=[], limit=CHROMA_WRITE_BATCH_SIZE, offset=offset)
+            if not page["ids"]:
+                return stale_ids
+            stale_ids.extend(doc_id for doc_id in page["ids"] if doc_id not in current_ids)
+            offset += len(page["ids"])
+
+    def _book_doc_id(self, book):
+        return f"book_{book['book_id']}"
+
+    def _book_document(self, book):
+        # Giá và tồn kho nằm trong metadata để thay đổi tồn kho không phải embed lại
+        return f"""
             Tên sách: {book['title']}
             Tác giả: {book['author']}
             Thể loại: {book['category']}
-            Mô tả: {book.get('description', '')}
-            Giá: {book['price']} VND
-            Tồn kho: {book['stock']} quyển
+            Mô tả: {book.get('description') or ''}
             """.strip()
 
-            documents.append(text)
-            metadatas.append({
-                "book_id": book['book_id'],
-                "title": book['title'],
-                "author": book['author'],
-                "price": book['price'],
-                "stock": book['stock'],
-                "category": book['category']
-            })
-            ids.append(f"book_{book['book_id']}")
+    def _book_metadata(self, book, document):
+        return {
+            "book_id": book['book_id'],
+            "title": book['title'],
+            "author": book['author'],
+            "price": book['price'],
+            "stock": book['stock'],
+            "category": book['category'],
+            "content_hash": hashlib.sha1(f"{EMBEDDING_SCHEMA_VERSION}\n{self.model_name}\n{document}".encode("utf-8")).hexdigest()
+        }
 
-        # Thêm dữ liệu mới
-        if documents:
-            self.collection.add(
-                documents=documents,
-                metadatas=metadatas,
-                ids=ids
-            )
-            logger.info(f"Đang tạo embeddings cho {len(books)} sách.")
-        else:
-            logger.warning("Không sách nào cung cấp, collection rỗng.")
+    def _prune_orphan_segments(self):
+        # Xóa thư mục HNSW của các collection đã bị xóa mà Chroma để lại trên đĩa
+        try:
+            conn = sqlite3.connect(os.path.join(self.persist_path, "chroma.sqlite3"))
+            try:
+                segment_ids = {row[0] for row in conn.execute("SELECT id FROM segments")}
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            logger.warning(f"Không đọc được danh sách segment của Chroma: {e}")
+            return
+
+        uuid_pattern = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$")
+        for name in os.listdir(self.persist_path):
+            path = os.path.join(self.persist_path, name)
+            if os.path.isdir(path) and uuid_pattern.match(name) and name not in segment_ids:
+                shutil.rmtree(path, ignore_errors=True)
+                logger.info(f"Đã xóa segment mồ côi: {name}")
 
     
-    def search_similar_books(self, query, top_k = 5):
+    def search_similar_books(self, query, top_k = 5, where = None):
+        kwargs = {"where": where} if where else {}
         results = self.collection.query(
-            query_texts=[query],
-            n_results=top_k
+            query_embeddings=[self.encode_query(query)],
+            n_results=top_k,
+            **kwargs
         )
 
         similar_books = []
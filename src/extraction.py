@@ -0,0 +1,186 @@
+import re
+
+# Các pattern được biên dịch một lần khi import, dùng chung cho mọi tin nhắn
+
+PHONE_ONLY_RE = re.compile(r'\+?[0-9]{10,12}')
+WHITESPACE_RE = re.compile(r'\s+')
+
+# Số điện thoại có nhãn, dùng cho nhận diện ý định tra cứu đơn hàng
+INTENT_PHONE_RE = re.compile(r'(?:sdt|số|phone|điện\s*thoại)[:\s]*(\+?[0-9]{10,12})', re.IGNORECASE)
+
+INTENT_KEYWORDS = {
+    "ORDER_STATUS": ['trạng thái đơn hàng', 'tra cứu đơn hàng', 'đơn hàng của tôi'],
+    "ORDER": ['đặt', 'mua', 'order', 'buy', 'muốn mua', 'đặt hàng', 'đặt sách'],
+    "SEARCH": ['tìm', 'search', 'có sách', 'sách nào', 'recommend', 'sách gì'],
+}
+# Mỗi ý định một alternation, kiểm tra theo thứ tự ưu tiên
+INTENT_KEYWORD_RES = [
+    (intent, 0.9 if intent == "ORDER_STATUS" else 0.8, re.compile('|'.join(re.escape(k) for k in keywords)))
+    for intent, keywords in INTENT_KEYWORDS.items()
+]
+
+CUSTOMER_PHONE_RE = re.compile(
+    r'(?:sdt|sđt|phone|điện\s*thoại|số|tel)(?:[\s:\-]*của\s*tôi)?(?:[\s:\-]*là)?[\s:\-]*'
+    r'(?P<labeled>\+?[0-9][0-9\s\-]{8,13}[0-9])'
+    r'|(?P<bare>\+?0?[0-9]{9,11})',
+    re.IGNORECASE
+)
+NAME_RE = re.compile(
+    r'(?:tên[\s:\-]*(?:tôi[\s:\-]*)?(?:là[\s:\-]+)?|name[\s:\-]*(?:is[\s:\-]+)?)([a-zA-ZÀ-ỹ\s]{2,})',
+    re.IGNORECASE
+)
+NAME_FORM_RE = re.compile(r'tên[\s:\-]*([^,]+?)(?:\s*[,]|$)', re.IGNORECASE)
+ADDRESS_RE = re.compile(
+    r'(?:địa\s*chỉ(?:[\s:\-]*giao\s*hàng)?|address)[\s:\-]*(.+?)(?=\s*(?:sdt|sđt|phone|tên|name|$))',
+    re.IGNORECASE
+)
+
+NUMBER_WORDS = {
+    'một': 1, 'hai': 2, 'ba': 3, 'bốn': 4, 'năm': 5,
+    'sáu': 6, 'bảy': 7, 'tám': 8, 'chín': 9, 'mười': 10
+}
+# Thứ tự nhóm là thứ tự ưu tiên: có nhãn > "N quyển" > "mua N" > số bằng chữ
+QUANTITY_RE = re.compile(
+    r'(?:số\s*lượng\s*:?\s*|quantity\s*:\s*|qty\s*:\s*)(?P<labeled>\d+)'
+    r'|(?P<unit>\d+)\s*(?:quyển|cuốn)'
+    r'|(?:mua|đặt)\s*(?P<verb>\d+)'
+    r'|\b(?P<word>' + '|'.join(NUMBER_WORDS) + r')\b'
+)
+QUANTITY_GROUPS = ('labeled', 'unit', 'verb', 'word')
+QUANTITY_HINT_RE = re.compile(r'số lượng|quantity|qty|quyển|cuốn')
+NUMBER_RE = re.compile(r'\b\d+\b')
+
+BOOK_INDEX_RE = re.compile(r'(?:cuốn\s*(?:số\s*)?|sách\s*(?:số\s*)?|(?:thứ|số)\s*|quyển\s*)(\d+)')
+REFERENCE_WORDS = {
+    'này': 0, 'đó': 0, 'kia': 0, 'trên': 0,
+    'đầu tiên': 0, 'đầu': 0, 'first': 0,
+    'thứ hai': 1, 'thứ 2': 1, 'second': 1,
+    'thứ ba': 2, 'thứ 3': 2, 'third': 2,
+    'cuối': -1, 'last': -1, 'cuối cùng': -1
+}
+_REFERENCE_RANK = {word: rank for rank, word in enumerate(REFERENCE_WORDS)}
+REFERENCE_RE = re.compile('|'.join(re.escape(w) for w in sorted(REFERENCE_WORDS, key=len, reverse=True)))
+
+
+def extract_phone_only(message):
+    clean_message = WHITESPACE_RE.sub('', message.strip())
+    return clean_message if PHONE_ONLY_RE.fullmatch(clean_message) else None
+
+
+def detect_intent(message):
+    phone = extract_phone_only(message)
+    if phone:
+        return {"intent": "ORDER_STATUS", "confidence": 1.0, "extracted_info": {"phone": phone}}
+
+    message_lower = message.lower()
+
+    match = INTENT_PHONE_RE.search(message_lower)
+    if match:
+        return {"intent": "ORDER_STATUS", "confidence": 0.9, "extracted_info": {"phone": match.group(1)}}
+
+    for intent, confidence, pattern in INTENT_KEYWORD_RES:
+        if pattern.search(message_lower):
+            return {"intent": intent, "confidence": confidence, "extracted_info": {}}
+
+    return {"intent": "GENERAL", "confidence": 0.5, "extracted_info": {}}
+
+
+def extract_phone(message):
+    labeled, bare = None, None
+    for match in CUSTOMER_PHONE_RE.finditer(message):
+        if match.group('labeled'):
+            phone = re.sub(r'[\s\-]+', '', match.group('labeled'))
+            if 10 <= len(phone) <= 12:
+                labeled = phone
+                break
+        elif bare is None and 10 <= len(match.group('bare')) <= 12:
+            bare = match.group('bare')
+    return labeled or bare
+
+
+def extract_name(message):
+    match = NAME_RE.search(message)
+    if match and match.group(1).strip():
+        return match.group(1).strip()
+
+    match = NAME_FORM_RE.search(message)
+    if match and len(match.group(1).strip()) > 1:
+        return match.group(1).strip()
+    return None
+
+
+def extract_address(message):
+    for match in ADDRESS_RE.finditer(message):
+        address = match.group(1).strip().rstrip(',;').strip()
+        if len(address) > 5:
+            return address
+    return None
+
+
+def extract_customer_info(message):
+    phone = extract_phone_only(message)
+    if phone:
+        return {'customer_name': None, 'phone': phone, 'address': None}
+
+    return {
+        'customer_name': extract_name(message),
+        'phone': extract_phone(message),
+        'address': extract_address(message)
+    }
+
+
+def extract_quantity(message):
+    message_lower = message.lower()
+
+    best = None
+    for match in QUANTITY_RE.finditer(message_lower):
+        for rank, group in enumerate(QUANTITY_GROUPS):
+            value = match.group(group)
+            if value is None:
+                continue
+            quantity = NUMBER_WORDS[value] if group == 'word' else int(value)
+            if 1 <= quantity <= 100 and (best is None or rank < best[0]):
+                best = (rank, quantity)
+            break
+        if best and best[0] == 0:
+            break
+
+    if best:
+        return best[1]
+
+    if QUANTITY_HINT_RE.search(message_lower):
+        for num_str in NUMBER_RE.findall(message_lower):
+            quantity = int(num_str)
+            if 1 <= quantity <= 100:
+                return quantity
+
+    return 0
+
+
+def extract_book_reference(message, last_books):
+    if not last_books:
+        return None
+
+    message_lower = message.lower()
+
+    for match in BOOK_INDEX_RE.finditer(message_lower):
+        index = int(match.group(1)) - 1
+        if 0 <= index < len(last_books):
+            return last_books[index]
+
+    words = set(REFERENCE_RE.findall(message_lower))
+    for word in sorted(words, key=_REFERENCE_RANK.get):
+        index = REFERENCE_WORDS[word]
+        if index == -1:
+            return last_books[-1]
+        elif index < len(last_books):
+            return last_books[index]
+
+    return None
+
+
+def extract_all(message):
+    info = extract_customer_info(message)
+    info['quantity'] = extract_quantity(message)
+    info['intent'] = detect_intent(message)
+    return info
@@ -0,0 +1,148 @@
+import os
+import sys
+import csv
+import json
+import time
+import queue
+import argparse
+import threading
+from itertools import islice
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config
+import logging
+
+logger = logging.getLogger(__name__)
+
+REQUIRED_FIELDS = ("title", "author", "price", "category")
+
+
+def read_records(path):
+    suffix = os.path.splitext(path)[1].lower()
+    if suffix not in (".csv", ".jsonl", ".ndjson"):
+        raise ValueError(f"Định dạng không hỗ trợ: {suffix} (chỉ nhận .csv, .jsonl)")
+
+    # Đọc từng dòng, không nạp cả file vào bộ nhớ
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        if suffix == ".csv":
+            yield from csv.DictReader(f)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def parse_book(record):
+    missing = [field for field in REQUIRED_FIELDS if not str(record.get(field) or "").strip()]
+    if missing:
+        raise ValueError(f"Thiếu trường: {', '.join(missing)}")
+
+    price = float(record["price"])
+    stock = int(record.get("stock") or 0)
+    if price < 0 or stock < 0:
+        raise ValueError("Giá và tồn kho không được âm")
+
+    description = str(record.get("description") or "").strip()
+    return {
+        "title": str(record["title"]).strip(),
+        "author": str(record["author"]).strip(),
+        "price": int(price) if price.is_integer() else price,
+        "stock": stock,
+        "category": str(record["category"]).strip(),
+        "description": description or None
+    }
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def import_catalog(path, db, embedding_handler=None, chunk_size=config.IMPORT_CHUNK_SIZE):
+    stats = {"rows": 0, "skipped": 0, "embedded": 0}
+    start = time.perf_counter()
+
+    # Embed trên thread riêng trong khi thread chính ghi SQLite lô kế tiếp.
+    # Hàng đợi có giới hạn để bộ nhớ không tăng khi embed chậm hơn ghi.
+    pending = queue.Queue(maxsize=2)
+    worker = None
+    if embedding_handler is not None:
+        def embed():
+            failed = False
+            while True:
+                books = pending.get()
+                if books is None:
+                    return
+                if failed:
+                    continue
+                try:
+                    stats["embedded"] += embedding_handler.upsert_book_embeddings(books)
+                except Exception as e:
+                    # Sách đã nằm trong SQLite, lần đồng bộ khi khởi động sẽ embed bù
+                    failed = True
+                    logger.error(f"Lỗi tạo embeddings, bỏ qua phần còn lại: {e}")
+
+        worker = threading.Thread(target=embed, name="import-embedding", daemon=True)
+        worker.start()
+
+    line = 0
+    try:
+        for records in chunked(read_records(path), chunk_size):
+            books = []
+            for record in records:
+                line += 1
+                try:
+                    books.append(parse_book(record))
+                except (ValueError, TypeError) as e:
+                    stats["skipped"] += 1
+                    logger.warning(f"Bỏ qua bản ghi {line}: {e}")
+
+            if not books:
+                continue
+
+            inserted = db.insert_books(books)
+            stats["rows"] += len(inserted)
+            if worker is not None:
+                pending.put(inserted)
+
+            elapsed = time.perf_counter() - start
+            logger.info(f"Đã nhập {stats['rows']} sách ({stats['rows'] / elapsed:.0f} dòng/s)")
+    finally:
+        if worker is not None:
+            pending.put(None)
+            worker.join()
+
+    stats["seconds"] = time.perf_counter() - start
+    stats["rows_per_sec"] = stats["rows"] / stats["seconds"] if stats["seconds"] else 0.0
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Nhập danh mục sách từ file CSV/JSONL vào SQLite và ChromaDB")
+    parser.add_argument("path", help="File .csv hoặc .jsonl với các cột title, author, price, stock, category, description")
+    parser.add_argument("--chunk-size", type=int, default=config.IMPORT_CHUNK_SIZE)
+    parser.add_argument("--no-embeddings", action="store_true",
+                        help="Chỉ ghi SQLite, embeddings sẽ được đồng bộ khi chatbot khởi động")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    from database import BookStoreDB
+    # Database mới chỉ chứa danh mục được nhập, không kèm sách mẫu
+    db = BookStoreDB(seed=False)
+    embedding_handler = None
+    if not args.no_embeddings:
+        from embedding import EmbeddingManager
+        embedding_handler = EmbeddingManager()
+
+    stats = import_catalog(args.path, db, embedding_handler, args.chunk_size)
+    print(f"Đã nhập {stats['rows']} sách, bỏ qua {stats['skipped']} bản ghi lỗi, "
+          f"embed {stats['embedded']} sách trong {stats['seconds']:.1f}s "
+          f"({stats['rows_per_sec']:.0f} dòng/s)")
+
+
+if __name__ == "__main__":
+    main()
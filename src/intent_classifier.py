@@ -0,0 +1,71 @@
+import os
+import sys
+import json
+import threading
+import numpy as np
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def load_utterances(path=config.INTENT_UTTERANCES_PATH):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class EmbeddingIntentClassifier:
+    def __init__(self, embedding_handler, utterances=None, min_margin=config.INTENT_CLASSIFIER_MIN_MARGIN):
+        self.embedding_handler = embedding_handler
+        self.utterances = utterances
+        self.min_margin = min_margin
+        self.labels = []
+        self.centroids = None
+        self._lock = threading.Lock()
+
+    @property
+    def available(self):
+        # Không chờ model đang nạp nền, khi đó để LLM xử lý
+        return self.centroids is not None or self.embedding_handler.model_loaded
+
+    def fit(self, utterances=None):
+        utterances = utterances or self.utterances or load_utterances()
+        labels = sorted({u["intent"] for u in utterances})
+        vectors = np.asarray(self.embedding_handler.encode([u["text"] for u in utterances]), dtype=np.float32)
+
+        centroids = []
+        for label in labels:
+            centroid = vectors[[u["intent"] == label for u in utterances]].mean(axis=0)
+            centroids.append(centroid / np.linalg.norm(centroid))
+
+        self.labels = labels
+        self.centroids = np.stack(centroids)
+        logger.info(f"Đã huấn luyện bộ phân loại ý định với {len(utterances)} câu mẫu")
+        return self
+
+    def _ensure_fitted(self):
+        if self.centroids is None:
+            with self._lock:
+                if self.centroids is None:
+                    self.fit()
+
+    def classify(self, user_message):
+        self._ensure_fitted()
+
+        vector = np.asarray(self.embedding_handler.encode_query(user_message), dtype=np.float32)
+        scores = self.centroids @ vector
+        order = np.argsort(scores)[::-1]
+        best, second = order[0], order[1]
+        margin = float(scores[best] - scores[second])
+
+        return {
+            "intent": self.labels[best],
+            "confidence": float(scores[best]),
+            "margin": margin,
+            "extracted_info": {},
+            "source": "embedding"
+        }
+
+    def is_confident(self, result):
+        return result["margin"] >= self.min_margin
@@ -2,160 +2,451 @@ import os
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import ollama
+import asyncio
 import json
 import re
-from config import OLLAMA_MODEL
+import math
+import time
+import threading
+from config import OLLAMA_MODEL, OLLAMA_ANALYSIS_MODEL, OLLAMA_KEEP_ALIVE, LLM_ANALYSIS_TIMEOUT, LLM_GENERATION_TIMEOUT
+from config import PROMPT_TOKEN_BUDGET_ANALYSIS, PROMPT_TOKEN_BUDGET_GENERATION, PROMPT_MAX_BOOKS
+from response_cache import ResponseCache
+from extraction import detect_intent
+from llm_scheduler import LLMScheduler, LLMRateLimited, PRIORITY_ORDER, PRIORITY_SEARCH, PRIORITY_GENERAL
+from circuit_breaker import CircuitBreaker
+from prompt_builder import PromptBuilder, compact_history, messages_tokens, truncate
 import logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+GENERAL_FALLBACK_RESPONSE = "Xin chào! Tôi có thể giúp bạn tìm kiếm sách hoặc đặt hàng. Bạn cần hỗ trợ gì?"
+NO_BOOKS_RESPONSE = "Xin lỗi tôi không thể tìm thấy bất kỳ cuốn sách nào phù hợp với yêu cầu của bạn"
+EXTRACTED_FIELDS = ["book_title", "quantity", "customer_name", "phone", "address", "search_query"]
+# Schema cho tham số format của Ollama: ý định và thông tin đơn hàng trong một lần gọi
+MESSAGE_ANALYSIS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "intent": {"type": "string", "enum": ["SEARCH", "ORDER", "ORDER_STATUS", "GENERAL"]},
+        "confidence": {"type": "number"},
+        "book_title": {"type": ["string", "null"]},
+        "quantity": {"type": ["integer", "null"]},
+        "customer_name": {"type": ["string", "null"]},
+        "phone": {"type": ["string", "null"]},
+        "address": {"type": ["string", "null"]},
+        "search_query": {"type": ["string", "null"]}
+    },
+    "required": ["intent", "confidence"] + EXTRACTED_FIELDS
+}
+# Tăng khi sửa prompt tìm kiếm để bỏ qua các câu trả lời đã cache
+SEARCH_PROMPT_VERSION = 2
+# Loại lời gọi, quyết định hạn chót: phân tích/trích xuất JSON phải nhanh, sinh câu trả lời được lâu hơn
+TASK_ANALYSIS = "analysis"
+TASK_GENERATION = "generation"
+
+# System prompt không chứa dữ liệu của lượt hiện tại để mọi lời gọi cùng loại có chung prefix
+ANALYSIS_SYSTEM_PROMPT = """
+Bạn phân tích tin nhắn của khách hàng cửa hàng sách BookStore.
+
+Phân loại intent thành một trong:
+- SEARCH: tìm kiếm, hỏi thông tin sách
+- ORDER: đặt mua sách
+- ORDER_STATUS: tra cứu đơn hàng
+- GENERAL: câu hỏi chung
+
+Trích xuất các trường sau, để null nếu câu không nhắc tới:
+- book_title: tên sách
+- quantity: số lượng
+- customer_name: tên KH
+- phone: số điện thoại
+- address: địa chỉ
+- search_query: từ khóa tìm kiếm
+
+Ngữ cảnh chỉ để tham khảo, chỉ phân tích tin nhắn cuối cùng của khách.
+Trả về JSON theo schema, confidence trong khoảng 0.0-1.0.
+"""
+SEARCH_SYSTEM_PROMPT = """
+Bạn là nhân viên tư vấn sách của cửa hàng BookStore.
+Hãy tạo phản hồi thân thiện, giới thiệu các sách tìm thấy và hỏi xem khách có muốn đặt mua không.
+Giữ nguyên thông tin giá và số lượng.
+"""
+GENERAL_SYSTEM_PROMPT = """
+Bạn là nhân viên tư vấn của cửa hàng sách BookStore.
+Hãy trả lời một cách thân thiện và chuyên nghiệp. Nếu câu hỏi không liên quan đến sách, hãy lịch sự chuyển hướng về việc tư vấn sách.
+"""
+
 class OlamaLLM:
-    def __init__(self):
+    def __init__(self, intent_classifier = None, scheduler = None):
         model_name = OLLAMA_MODEL
         self.model_name = model_name
+        # Phân tích ý định/trích xuất JSON dùng model nhỏ, chỉ câu trả lời tự do dùng model lớn
+        self.models = {TASK_ANALYSIS: OLLAMA_ANALYSIS_MODEL, TASK_GENERATION: model_name}
+        # Client không giới hạn thời gian chỉ dùng để nạp model lúc khởi động
         self.client = ollama.Client()
+        self.timeouts = {TASK_ANALYSIS: LLM_ANALYSIS_TIMEOUT, TASK_GENERATION: LLM_GENERATION_TIMEOUT}
+        # httpx áp timeout cho từng lần đọc: với lời gọi không stream, Ollama chỉ trả dữ liệu khi sinh xong.
+        # Timeout chỉ đặt được khi tạo client nên giữ một client cho mỗi số giây còn lại
+        self._timed_clients = {}
+        self.async_client = ollama.AsyncClient()
+        # Model lỗi/chậm liên tục thì trả lời dự phòng ngay thay vì chờ hết hạn chót từng lời gọi.
+        # Mỗi loại lời gọi một breaker để model nhỏ quá tải không chặn model sinh câu trả lời và ngược lại
+        self.breakers = {task: CircuitBreaker(task, ignored_exceptions=(LLMRateLimited,)) for task in self.models}
+
+        self.analysis_prompt = PromptBuilder(ANALYSIS_SYSTEM_PROMPT, PROMPT_TOKEN_BUDGET_ANALYSIS)
+        self.search_prompt = PromptBuilder(SEARCH_SYSTEM_PROMPT, PROMPT_TOKEN_BUDGET_GENERATION)
+        self.general_prompt = PromptBuilder(GENERAL_SYSTEM_PROMPT, PROMPT_TOKEN_BUDGET_GENERATION)
+        self.response_cache = ResponseCache()
+        self.intent_classifier = intent_classifier
+        # Mọi lời gọi Ollama đi qua bộ lập lịch: giới hạn đồng thời, ưu tiên luồng đặt hàng
+        self.scheduler = scheduler or LLMScheduler()
 
+        # Nạp model vào Ollama ở luồng nền thay vì chặn lúc khởi động
+        self.ready = threading.Event()
+        self.available = False
+        threading.Thread(target=self._warm_up, name="llm-warm-up", daemon=True).start()
+    
+    def _warm_up(self):
+        try:
+            # Nạp model lớn trước: không có nó thì chatbot chỉ dùng câu trả lời dự phòng
+            self.available = self._preload(self.model_name)
+            analysis_model = self.models[TASK_ANALYSIS]
+            if self.available and analysis_model != self.model_name and not self._preload(analysis_model):
+                logger.info(f"Dùng {self.model_name} cho phân tích ý định thay cho {analysis_model}")
+                self.models[TASK_ANALYSIS] = self.model_name
+        finally:
+            self.ready.set()
+    
+    def _preload(self, model):
         try:
-            self.client.chat(model=model_name, messages=[{"role": "user", "content": "test"}])
-            logger.info(f"Model {model_name} đã sẵn sàng")
+            # Danh sách messages rỗng chỉ nạp model, không sinh token
+            self.client.chat(model=model, messages=[], keep_alive=OLLAMA_KEEP_ALIVE)
+            logger.info(f"Model {model} đã sẵn sàng")
+            return True
         except Exception as e:
-            logger.info(f"Lỗi kết nối với {model_name}")
-            logger.info(f"Vui lòng đảm bảo rằng bạn đã cài đặt Ollama và pull Llama3.1:8b")
+            logger.info(f"Lỗi kết nối với {model}")
+            logger.info(f"Vui lòng đảm bảo rằng bạn đã cài đặt Ollama và pull {model}")
+            return False
     
     def enhanced_intent_classification(self, user_message, context = None):
         rule_based_result = self._rule_based_intent_detection(user_message)
         
         if rule_based_result["confidence"] < 0.7:
+            local_result = self._local_intent_detection(user_message)
+            if local_result:
+                return local_result
+            
             llm_result = self._llm_intent_detection(user_message, context)
             if llm_result["confidence"] > rule_based_result["confidence"]:
                 return llm_result
         
         return rule_based_result
     
-    def _rule_based_intent_detection(self, user_message):
-        message_lower = user_message.lower()
-        confidence = 1.0
-        
-        clean_message = re.sub(r'\s+', '', user_message.strip())
-        if re.fullmatch(r'(\+?[0-9]{10,12})', clean_message):
-            return {
-                "intent": "ORDER_STATUS", 
-                "confidence": 1.0,
-                "extracted_info": {"phone": clean_message}
-            }
-        
-        phone_patterns = [
-            r'sdt[:\s]*(\+?[0-9]{10,12})', r'số[:\s]*(\+?[0-9]{10,12})',
-            r'phone[:\s]*(\+?[0-9]{10,12})', r'điện\s*thoại[:\s]*(\+?[0-9]{10,12})'
-        ]
+    async def aenhanced_intent_classification(self, user_message, context = None):
+        rule_based_result = self._rule_based_intent_detection(user_message)
         
-        for pattern in phone_patterns:
-            match = re.search(pattern, message_lower, re.IGNORECASE)
-            if match:
-                return {
-                    "intent": "ORDER_STATUS",
-                    "confidence": 0.9,
-                    "extracted_info": {"phone": match.group(1)}
-                }
+        if rule_based_result["confidence"] < 0.7:
+            local_result = await asyncio.to_thread(self._local_intent_detection, user_message)
+            if local_result:
+                return local_result
+            
+            llm_result = await self._allm_intent_detection(user_message, context)
+            if llm_result["confidence"] > rule_based_result["confidence"]:
+                return llm_result
         
-        order_status_keywords = ['trạng thái đơn hàng', 'tra cứu đơn hàng', 'đơn hàng của tôi']
-        order_keywords = ['đặt', 'mua', 'order', 'buy', 'muốn mua', 'đặt hàng', 'đặt sách']
-        search_keywords = ['tìm', 'search', 'có sách', 'sách nào', 'recommend','sách gì']
+        return rule_based_result
+    
+    def _rule_based_intent_detection(self, user_message):
+        return detect_intent(user_message)
+    
+    def _local_intent_detection(self, user_message):
+        if not self.intent_classifier or not self.intent_classifier.available:
+            return None
         
-        if any(keyword in message_lower for keyword in order_status_keywords):
-            return {"intent": "ORDER_STATUS", "confidence": 0.9, "extracted_info": {}}
-        elif any(keyword in message_lower for keyword in order_keywords):
-            return {"intent": "ORDER", "confidence": 0.8, "extracted_info": {}}
-        elif any(keyword in message_lower for keyword in search_keywords):
-            return {"intent": "SEARCH", "confidence": 0.8, "extracted_info": {}}
+        try:
+            result = self.intent_classifier.classify(user_message)
+        except Exception as e:
+            logger.warning(f"Lỗi phân loại ý định cục bộ: {e}")
+            return None
         
-        return {"intent": "GENERAL", "confidence": 0.5, "extracted_info": {}}
+        return result if self.intent_classifier.is_confident(result) else None
     
     def _llm_intent_detection(self, user_message, context = None):
-        prompt = f"""
-Phân tích ý định người dùng và trích xuất thông tin từ câu: "{user_message}"
-
-Context: {context}
-
-Phân loại thành một trong:
-- SEARCH: tìm kiếm, hỏi thông tin sách
-- ORDER: đặt mua sách 
-- ORDER_STATUS: tra cứu đơn hàng
-- GENERAL: câu hỏi chung
-
-Trả về JSON: {{"intent": "...", "confidence": 0.0-1.0, "extracted_info": {{...}}}}
-
-Thông tin có thể trích xuất:
-- book_title: tên sách
-- quantity: số lượng
-- customer_name: tên KH
-- phone: số điện thoại
-- address: địa chỉ
-- search_query: từ khóa tìm kiếm
-"""
-
+        return self.analyze_message(user_message, context)
+    
+    async def _allm_intent_detection(self, user_message, context = None):
+        return await self.aanalyze_message(user_message, context)
+    
+    def analyze_message(self, user_message, context = None, available_books = None):
         try:
-            response = self.client.chat(
-                model=self.model_name,
-                messages=[{"role": "user", "content": prompt}],
+            response = self._chat(
+                PRIORITY_ORDER, TASK_ANALYSIS,
+                messages=self._analysis_messages(user_message, context, available_books),
+                format=MESSAGE_ANALYSIS_SCHEMA,
                 options={"temperature": 0.1}
             )
+            return self._parse_analysis(response['message']['content'])
             
-            import json
-            result = json.loads(response['message']['content'])
-            return result
+        except Exception as e:
+            return {"intent": "GENERAL", "confidence": 0.3, "extracted_info": {}}
+    
+    async def aanalyze_message(self, user_message, context = None, available_books = None):
+        try:
+            response = await self._achat(
+                PRIORITY_ORDER, TASK_ANALYSIS,
+                messages=self._analysis_messages(user_message, context, available_books),
+                format=MESSAGE_ANALYSIS_SCHEMA,
+                options={"temperature": 0.1}
+            )
+            return self._parse_analysis(response['message']['content'])
             
         except Exception as e:
             return {"intent": "GENERAL", "confidence": 0.3, "extracted_info": {}}
     
     def extract_order_info(self, user_message, available_books = None):
-        books_text = ""
-        if available_books:
-            books_text = "\n".join([f"- {book['title']} (ID: {book['book_id']})" for book in available_books])
-        
-        prompt = f"""
-        Trích xuất thông tin đặt hàng từ: "{user_message}"
-        
-        Sách có sẵn: {books_text}
-        
-        Trả về JSON:
-        {{
-            "book_title": "tên sách",
-            "quantity": số_lượng,
-            "customer_name": "tên KH", 
-            "phone": "số điện thoại",
-            "address": "địa chỉ",
-            "confidence": 0.0-1.0
-        }}
-        """
+        return self._order_info_from_analysis(self.analyze_message(user_message, available_books=available_books))
+    
+    async def aextract_order_info(self, user_message, available_books = None):
+        analysis = await self.aanalyze_message(user_message, available_books=available_books)
+        return self._order_info_from_analysis(analysis)
+    
+    def _analysis_messages(self, user_message, context = None, available_books = None):
+        context = context or {}
+        books = available_books or context.get("last_books") or []
+        
+        # Thứ tự ưu tiên khi cắt theo ngân sách: đơn đang chờ, sách vừa gợi ý, rồi lịch sử hội thoại
+        sections = [
+            ("Đơn đang chờ:", [self._pending_order_line(context.get("pending_order"))], False),
+            ("Sách vừa gợi ý:", self._book_reference_lines(books), False),
+            ("Hội thoại trước:", compact_history(context.get("conversation_history") or [], user_message), True)
+        ]
+        return self.analysis_prompt.build(f'Tin nhắn của khách: "{user_message}"', sections)
+    
+    def _pending_order_line(self, pending_order):
+        if not pending_order:
+            return None
+        
+        book = pending_order.get("book_info") or {}
+        fields = [f"book_title: {book['title']}"] if book.get("title") else []
+        for field in ("quantity", "customer_name", "phone", "address"):
+            if pending_order.get(field):
+                fields.append(f"{field}: {pending_order[field]}")
+        return ", ".join(fields)
+    
+    def _book_reference_lines(self, books):
+        # Chỉ tên và ID, không đưa cả dict sách (mô tả, điểm số) vào prompt
+        return [f"{i}. {truncate(book['title'], 80)} (ID: {book['book_id']})" for i, book in enumerate(books[:PROMPT_MAX_BOOKS], 1)]
+    
+    def _parse_analysis(self, content):
+        json_match = re.search(r'\{.*\}', content, re.DOTALL)
+        result = json.loads(json_match.group() if json_match else content)
+        
+        # Chấp nhận cả dạng cũ có extracted_info lồng bên trong
+        extracted_info = dict(result.get("extracted_info") or {})
+        for field in EXTRACTED_FIELDS:
+            if result.get(field) is not None:
+                extracted_info[field] = result[field]
+        
+        return {
+            "intent": result.get("intent", "GENERAL"),
+            "confidence": float(result.get("confidence", 0.5)),
+            "extracted_info": {k: v for k, v in extracted_info.items() if v not in (None, "")},
+            "source": "llm"
+        }
+    
+    def _order_info_from_analysis(self, analysis):
+        order_info = dict(analysis["extracted_info"])
+        order_info["confidence"] = analysis["confidence"]
+        # Đảm bảo có quantity mặc định
+        if not order_info.get('quantity'):
+            order_info['quantity'] = 1
+        return order_info
+    
+    def generate_search_response(self, user_query, books_info):
+        if not books_info:
+            return NO_BOOKS_RESPONSE
+        
+        cache_key = self._search_cache_key(user_query, books_info)
+        cached = self.response_cache.get(cache_key)
+        if cached is not None:
+            return cached
+        
+        books_text = self._format_books_text(books_info)
 
         try:
-            response = self.client.chat(
-                model=self.model_name,
-                messages=[{"role": "user", "content": prompt}],
-                options={"temperature": 0.1}
+            response = self._chat(
+                PRIORITY_SEARCH, TASK_GENERATION,
+                messages=self._search_messages(user_query, books_info),
+                options={"temperature": 0.7}
             )
-            
-            import json
             content = response['message']['content']
-            json_match = re.search(r'\{.*\}', content, re.DOTALL)
-            
-            if json_match:
-                result = json.loads(json_match.group())
-                # Đảm bảo có quantity mặc định
-                if not result.get('quantity'):
-                    result['quantity'] = 1
-                return result
-            else:
-                return {"quantity": 1, "confidence": 0.5}
-                
+            self.response_cache.put(cache_key, content)
+            return content
         except Exception as e:
-            return {"quantity": 1, "confidence": 0.3}
+            logger.error(f"Lỗi khi sinh phản hồi tìm kiếm: {e}")
+            return f"Tìm thấy {len(books_info)} sách phù hợp:\n{books_text}"
     
-    def generate_search_response(self, user_query, books_info):
+    async def agenerate_search_response(self, user_query, books_info):
+        if not books_info:
+            return NO_BOOKS_RESPONSE
+        
+        cache_key = self._search_cache_key(user_query, books_info)
+        cached = self.response_cache.get(cache_key)
+        if cached is not None:
+            return cached
+        
+        books_text = self._format_books_text(books_info)
+
+        try:
+            response = await self._achat(
+                PRIORITY_SEARCH, TASK_GENERATION,
+                messages=self._search_messages(user_query, books_info),
+                options={"temperature": 0.7}
+            )
+            content = response['message']['content']
+            self.response_cache.put(cache_key, content)
+            return content
+        except Exception as e:
+            logger.error(f"Lỗi khi sinh phản hồi tìm kiếm: {e}")
+            return f"Tìm thấy {len(books_info)} sách phù hợp:\n{books_text}"
+    
+    def stream_search_response(self, user_query, books_info):
+        if not books_info:
+            yield NO_BOOKS_RESPONSE
+            return
+        
+        cache_key = self._search_cache_key(user_query, books_info)
+        cached = self.response_cache.get(cache_key)
+        if cached is not None:
+            yield cached
+            return
+        
+        books_text = self._format_books_text(books_info)
+        fallback = f"Tìm thấy {len(books_info)} sách phù hợp:\n{books_text}"
+        yield from self._stream_chat(self._search_messages(user_query, books_info), {"temperature": 0.7}, fallback, cache_key, PRIORITY_SEARCH)
+    
+    async def astream_search_response(self, user_query, books_info):
         if not books_info:
-            return "Xin lỗi tôi không thể tìm thấy bất kỳ cuốn sách nào phù hợp với yêu cầu của bạn"
+            yield NO_BOOKS_RESPONSE
+            return
+        
+        cache_key = self._search_cache_key(user_query, books_info)
+        cached = self.response_cache.get(cache_key)
+        if cached is not None:
+            yield cached
+            return
         
+        books_text = self._format_books_text(books_info)
+        fallback = f"Tìm thấy {len(books_info)} sách phù hợp:\n{books_text}"
+        async for chunk in self._astream_chat(self._search_messages(user_query, books_info), {"temperature": 0.7}, fallback, cache_key, PRIORITY_SEARCH):
+            yield chunk
+    
+    def _client_for(self, remaining):
+        # Làm tròn lên theo giây: lời gọi có thể vượt hạn chót tối đa 1 giây
+        seconds = max(1, math.ceil(remaining))
+        client = self._timed_clients.get(seconds)
+        if client is None:
+            client = self._timed_clients.setdefault(seconds, ollama.Client(timeout=seconds))
+        return client
+    
+    def _chat(self, priority, task, **kwargs):
+        # Một hạn chót cho cả thời gian chờ hàng đợi lẫn lời gọi model;
+        # breaker chỉ đo thời gian của model để đánh giá lời gọi chậm
+        timeout = self.timeouts[task]
+        deadline = time.monotonic() + timeout
+        with self.breakers[task].guard(slow_after=timeout / 2) as call:
+            with self.scheduler.slot(priority, timeout=timeout):
+                call.start()
+                response = self._client_for(deadline - call.started).chat(model=self.models[task], keep_alive=OLLAMA_KEEP_ALIVE, **kwargs)
+        self._log_usage(task, kwargs["messages"], response, call.started)
+        return response
+    
+    async def _achat(self, priority, task, **kwargs):
+        timeout = self.timeouts[task]
+        deadline = time.monotonic() + timeout
+        with self.breakers[task].guard(slow_after=timeout / 2) as call:
+            async with self.scheduler.aslot(priority, timeout=timeout):
+                call.start()
+                response = await asyncio.wait_for(self.async_client.chat(model=self.models[task], keep_alive=OLLAMA_KEEP_ALIVE, **kwargs), deadline - call.started)
+        self._log_usage(task, kwargs["messages"], response, call.started)
+        return response
+    
+    def _stream_chat(self, messages, options, fallback, cache_key = None, priority = PRIORITY_GENERAL):
+        parts = []
+        last_part = None
+        timeout = self.timeouts[TASK_GENERATION]
+        try:
+            # Với stream, hạn chót áp cho từng đoạn (token đầu tiên và khoảng dừng giữa các token)
+            # để người đọc chậm không bị cắt ngang câu trả lời
+            with self.breakers[TASK_GENERATION].guard() as call:
+                # Giữ slot trong suốt quá trình stream vì Ollama vẫn đang sinh token
+                with self.scheduler.slot(priority, timeout=timeout):
+                    call.start()
+                    stream = self._client_for(timeout).chat(model=self.models[TASK_GENERATION], messages=messages, options=options, stream=True, keep_alive=OLLAMA_KEEP_ALIVE)
+                    try:
+                        for part in stream:
+                            last_part = part
+                            content = part['message']['content']
+                            if content:
+                                parts.append(content)
+                                yield content
+                    finally:
+                        stream.close()
+            self._log_usage(TASK_GENERATION, messages, last_part, call.started)
+            if cache_key is not None:
+                self.response_cache.put(cache_key, "".join(parts))
+        except Exception as e:
+            logger.error(f"Lỗi khi stream phản hồi: {e}")
+            # Chỉ trả lời dự phòng khi chưa gửi token nào cho người dùng
+            if not parts:
+                yield fallback
+    
+    async def _astream_chat(self, messages, options, fallback, cache_key = None, priority = PRIORITY_GENERAL):
+        parts = []
+        last_part = None
+        timeout = self.timeouts[TASK_GENERATION]
+        try:
+            with self.breakers[TASK_GENERATION].guard() as call:
+                async with self.scheduler.aslot(priority, timeout=timeout):
+                    call.start()
+                    stream = await asyncio.wait_for(self.async_client.chat(model=self.models[TASK_GENERATION], messages=messages, options=options, stream=True, keep_alive=OLLAMA_KEEP_ALIVE), timeout)
+                    try:
+                        while True:
+                            try:
+                                part = await asyncio.wait_for(stream.__anext__(), timeout)
+                            except StopAsyncIteration:
+                                break
+                            last_part = part
+                            content = part['message']['content']
+                            if content:
+                                parts.append(content)
+                                yield content
+                    finally:
+                        await stream.aclose()
+            self._log_usage(TASK_GENERATION, messages, last_part, call.started)
+            if cache_key is not None:
+                self.response_cache.put(cache_key, "".join(parts))
+        except Exception as e:
+            logger.error(f"Lỗi khi stream phản hồi: {e}")
+            if not parts:
+                yield fallback
+    
+    def breaker_stats(self):
+        return {task: {"model": self.models[task], **breaker.stats()} for task, breaker in self.breakers.items()}
+    
+    def _log_usage(self, task, messages, response, start):
+        # Chunk cuối của stream và phản hồi không stream có số token Ollama thực sự xử lý;
+        # prompt_eval_count thấp hơn ước lượng khi prefix được lấy lại từ KV cache
+        usage = response or {}
+        logger.info(
+            f"LLM {task} ({self.models[task]}): prompt ~{messages_tokens(messages)} token ước lượng, "
+            f"prompt_eval={usage.get('prompt_eval_count')}, eval={usage.get('eval_count')}, "
+            f"{(time.monotonic() - start) * 1000:.0f}ms"
+        )
+    
+    def _search_cache_key(self, user_query, books_info):
+        # Chỉ 3 sách đầu được đưa vào prompt
+        return ResponseCache.make_key(user_query, books_info[:3], self.model_name, SEARCH_PROMPT_VERSION)
+    
+    def _format_books_text(self, books_info):
         books_text = ""
         for i, book in enumerate(books_info[:3], 1):
             books_text += f"""
@@ -165,42 +456,45 @@ Thông tin có thể trích xuất:
 - Giá: {book['price']:,} VND
 - Tồn kho: {book['stock']} quyển
 """
-        
-        prompt = f"""
-Bạn là nhân viên tư vấn sách. Khách hàng hỏi: "{user_query}"
-
-Sách tìm thấy:
-{books_text}
-
-Hãy tạo phản hồi thân thiện, giới thiệu các sách này và hỏi xem họ có muốn đặt mua không.
-Giữ nguyên thông tin giá và số lượng.
-"""
-
-        try:
-            response = self.client.chat(
-                model=self.model_name,
-                messages=[{"role":"user", "content": prompt}],
-                options={"temperature": 0.7}
-            )
-            return response['message']['content']
-        except Exception as e:
-            logger.error(f"Lỗi khi sinh phản hồi tìm kiếm: {e}")
-            return f"Tìm thấy {len(books_info)} sách phù hợp:\n{books_text}"
+        return books_text
+    
+    def _search_messages(self, user_query, books_info):
+        books_lines = [
+            f"{i}. {book['title']} - {book['author']} - {book['category']} - {book['price']:,} VND - còn {book['stock']} quyển"
+            for i, book in enumerate(books_info[:3], 1)
+        ]
+        return self.search_prompt.build(f'Khách hàng hỏi: "{user_query}"', [("Sách tìm thấy:", books_lines, False)])
     
     def generate_general_response(self, user_message):
-      prompt = f"""
-      Bạn là nhân viên tư vấn của cửa hàng sách BookStore. Khách hàng đã hỏi: "{user_message}"
-      
-      Hãy trả lời một cách thân thiện và chuyên nghiệp. Nếu câu hỏi không liên quan đến sách, hãy lịch sự chuyển hướng về việc tư vấn sách.
-      """
-      
       try:
-          response = self.client.chat(
-              model=self.model_name,
-              messages=[{"role": "user", "content": prompt}],
+          response = self._chat(
+              PRIORITY_GENERAL, TASK_GENERATION,
+              messages=self._general_messages(user_message),
               options={"temperature": 0.7}
           )
           return response['message']['content']
       except Exception as e:
-          print(f"Lỗi khi tạo phản hồi chung: {e}")
-          return "Xin chào! Tôi có thể giúp bạn tìm kiếm sách hoặc đặt hàng. Bạn cần hỗ trợ gì?"
\ No newline at end of file
+          logger.error(f"Lỗi khi tạo phản hồi chung: {e}")
+          return GENERAL_FALLBACK_RESPONSE
+    
+    async def agenerate_general_response(self, user_message):
+      try:
+          response = await self._achat(
+              PRIORITY_GENERAL, TASK_GENERATION,
+              messages=self._general_messages(user_message),
+              options={"temperature": 0.7}
+          )
+          return response['message']['content']
+      except Exception as e:
+          logger.error(f"Lỗi khi tạo phản hồi chung: {e}")
+          return GENERAL_FALLBACK_RESPONSE
+    
+    def stream_general_response(self, user_message):
+      yield from self._stream_chat(self._general_messages(user_message), {"temperature": 0.7}, GENERAL_FALLBACK_RESPONSE, priority=PRIORITY_GENERAL)
+    
+    async def astream_general_response(self, user_message):
+      async for chunk in self._astream_chat(self._general_messages(user_message), {"temperature": 0.7}, GENERAL_FALLBACK_RESPONSE, priority=PRIORITY_GENERAL):
+          yield chunk
+    
+    def _general_messages(self, user_message):
+      return self.general_prompt.build(f'Khách hàng hỏi: "{user_message}"')
@@ -0,0 +1,221 @@
+import os
+import sys
+import time
+import heapq
+import asyncio
+import itertools
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager, asynccontextmanager
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Số nhỏ hơn được phục vụ trước
+PRIORITY_ORDER = 0      # trích xuất thông tin, phân tích ý định trong luồng đặt hàng
+PRIORITY_SEARCH = 1     # câu trả lời kèm kết quả tìm kiếm
+PRIORITY_GENERAL = 2    # trò chuyện chung
+PRIORITY_NAMES = {PRIORITY_ORDER: "order", PRIORITY_SEARCH: "search", PRIORITY_GENERAL: "general"}
+
+WAIT_SAMPLES = 1024
+
+# Session đang được xử lý, do chatbot đặt cho mỗi lượt để áp giới hạn tần suất
+current_session = contextvars.ContextVar("llm_session", default=None)
+
+
+class LLMRateLimited(Exception):
+    pass
+
+
+class LLMQueueTimeout(Exception):
+    pass
+
+
+class _Waiter:
+    def __init__(self):
+        self.granted = False
+        self.cancelled = False
+        self._event = threading.Event()
+
+    def grant(self):
+        self._event.set()
+
+    def wait(self, timeout):
+        return self._event.wait(timeout)
+
+
+class _AsyncWaiter:
+    def __init__(self):
+        self.granted = False
+        self.cancelled = False
+        self._loop = asyncio.get_running_loop()
+        self._future = self._loop.create_future()
+
+    def grant(self):
+        # Có thể được gọi từ thread khác khi một lượt đồng bộ trả slot
+        self._loop.call_soon_threadsafe(self._set_result)
+
+    def _set_result(self):
+        if not self._future.done():
+            self._future.set_result(True)
+
+    async def await_grant(self, timeout):
+        await asyncio.wait_for(asyncio.shield(self._future), timeout)
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class LLMScheduler:
+    def __init__(self, max_concurrent=config.LLM_MAX_CONCURRENT, queue_timeout=config.LLM_QUEUE_TIMEOUT,
+                 session_rate=config.LLM_SESSION_RATE, session_burst=config.LLM_SESSION_BURST,
+                 max_tracked_sessions=config.MAX_SESSIONS):
+        self.max_concurrent = max_concurrent
+        self.queue_timeout = queue_timeout
+        self.session_rate = session_rate
+        self.session_burst = session_burst
+        self.max_tracked_sessions = max_tracked_sessions
+
+        self._lock = threading.Lock()
+        self._queue = []
+        self._sequence = itertools.count()
+        self._active = 0
+        self._buckets = {}
+
+        self._depth = {priority: 0 for priority in PRIORITY_NAMES}
+        self._max_depth = {priority: 0 for priority in PRIORITY_NAMES}
+        self._completed = {priority: 0 for priority in PRIORITY_NAMES}
+        self._rate_limited = {priority: 0 for priority in PRIORITY_NAMES}
+        self._timed_out = {priority: 0 for priority in PRIORITY_NAMES}
+        self._waits = {priority: deque(maxlen=WAIT_SAMPLES) for priority in PRIORITY_NAMES}
+
+    def _wait_timeout(self, timeout):
+        # Người gọi có hạn chót riêng thì không chờ quá hạn đó
+        return self.queue_timeout if timeout is None else max(0.0, min(timeout, self.queue_timeout))
+
+    @contextmanager
+    def slot(self, priority, session_id=None, timeout=None):
+        timeout = self._wait_timeout(timeout)
+        waiter = self._enqueue(priority, session_id, _Waiter())
+        start = time.monotonic()
+        if not waiter.wait(timeout):
+            self._abandon(priority, waiter)
+            raise LLMQueueTimeout(f"Chờ LLM quá {timeout:.1f}s")
+        self._record_wait(priority, start)
+        try:
+            yield
+        finally:
+            self._release(priority)
+
+    @asynccontextmanager
+    async def aslot(self, priority, session_id=None, timeout=None):
+        timeout = self._wait_timeout(timeout)
+        waiter = self._enqueue(priority, session_id, _AsyncWaiter())
+        start = time.monotonic()
+        try:
+            await waiter.await_grant(timeout)
+        except asyncio.TimeoutError:
+            self._abandon(priority, waiter)
+            raise LLMQueueTimeout(f"Chờ LLM quá {timeout:.1f}s")
+        except asyncio.CancelledError:
+            self._abandon(priority, waiter, timed_out=False)
+            raise
+        self._record_wait(priority, start)
+        try:
+            yield
+        finally:
+            self._release(priority)
+
+    def _enqueue(self, priority, session_id, waiter):
+        session_id = session_id or current_session.get()
+        with self._lock:
+            if session_id is not None and not self._take_token(session_id):
+                self._rate_limited[priority] += 1
+                raise LLMRateLimited(f"Session {session_id} gọi LLM quá nhiều")
+
+            heapq.heappush(self._queue, (priority, next(self._sequence), waiter))
+            self._depth[priority] += 1
+            self._max_depth[priority] = max(self._max_depth[priority], self._depth[priority])
+            self._dispatch()
+        return waiter
+
+    def _abandon(self, priority, waiter, timed_out=True):
+        with self._lock:
+            if waiter.granted:
+                # Slot đã được cấp đúng lúc hết hạn chờ: trả lại cho người khác
+                self._active -= 1
+                self._dispatch()
+            else:
+                waiter.cancelled = True
+                self._depth[priority] -= 1
+            if timed_out:
+                self._timed_out[priority] += 1
+
+    def _release(self, priority):
+        with self._lock:
+            self._active -= 1
+            self._completed[priority] += 1
+            self._dispatch()
+
+    def _dispatch(self):
+        while self._active < self.max_concurrent and self._queue:
+            priority, _, waiter = heapq.heappop(self._queue)
+            if waiter.cancelled:
+                continue
+            self._depth[priority] -= 1
+            self._active += 1
+            waiter.granted = True
+            waiter.grant()
+
+    def _take_token(self, session_id):
+        bucket = self._buckets.pop(session_id, None)
+        if bucket is None:
+            bucket = TokenBucket(self.session_rate, self.session_burst)
+        # Giữ thứ tự truy cập để bỏ bucket của session cũ nhất khi quá nhiều
+        self._buckets[session_id] = bucket
+        if len(self._buckets) > self.max_tracked_sessions:
+            del self._buckets[next(iter(self._buckets))]
+        return bucket.take()
+
+    def _record_wait(self, priority, start):
+        with self._lock:
+            self._waits[priority].append(time.monotonic() - start)
+
+    def stats(self):
+        with self._lock:
+            by_priority = {}
+            for priority, name in PRIORITY_NAMES.items():
+                waits = sorted(self._waits[priority])
+                by_priority[name] = {
+                    "queue_depth": self._depth[priority],
+                    "max_queue_depth": self._max_depth[priority],
+                    "completed": self._completed[priority],
+                    "rate_limited": self._rate_limited[priority],
+                    "timed_out": self._timed_out[priority],
+                    "wait_p50_ms": self._percentile(waits, 50),
+                    "wait_p99_ms": self._percentile(waits, 99),
+                }
+            return {"active": self._active, "max_concurrent": self.max_concurrent, "priorities": by_priority}
+
+    @staticmethod
+    def _percentile(values, p):
+        if not values:
+            return 0.0
+        return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))] * 1000
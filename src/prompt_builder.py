@@ -0,0 +1,82 @@
+import os
+import sys
+import math
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config
+
+ELLIPSIS = "…"
+
+
+def estimate_tokens(text):
+    # Không có tokenizer của model ở phía client: ước lượng theo số ký tự (tiếng Việt có dấu tốn token hơn tiếng Anh)
+    if not text:
+        return 0
+    return math.ceil(len(text) / config.PROMPT_CHARS_PER_TOKEN)
+
+
+def truncate(text, max_chars):
+    text = " ".join(str(text).replace("**", "").split())
+    if len(text) <= max_chars:
+        return text
+    return text[:max(0, max_chars - 1)].rstrip() + ELLIPSIS
+
+
+def compact_history(history, current_message=None):
+    turns = list(history)
+    # Tin nhắn hiện tại đã được thêm vào lịch sử trước khi phân tích, không lặp lại trong prompt
+    if turns and turns[-1].get("role") == "user" and turns[-1].get("message") == current_message:
+        turns = turns[:-1]
+
+    lines = []
+    for i, turn in enumerate(turns):
+        # Lượt gần nhất giữ nhiều nội dung hơn, các lượt cũ chỉ còn phần đầu
+        recent = i >= len(turns) - 2
+        max_chars = config.PROMPT_RECENT_TURN_CHARS if recent else config.PROMPT_OLDER_TURN_CHARS
+        role = "Khách" if turn.get("role") == "user" else "Bot"
+        lines.append(f"{role}: {truncate(turn.get('message', ''), max_chars)}")
+    return lines
+
+
+class PromptBuilder:
+    def __init__(self, system_prompt, budget):
+        # System prompt cố định đứng đầu để Ollama tái sử dụng KV cache của phần prefix giữa các lời gọi
+        self.system_prompt = system_prompt.strip()
+        self.budget = budget
+        self.system_tokens = estimate_tokens(self.system_prompt)
+
+    def build(self, user_text, sections=()):
+        # sections: (tiêu đề, các dòng, giữ phần cuối?) theo thứ tự ưu tiên giảm dần;
+        # dòng nào không vừa ngân sách thì bị bỏ
+        remaining = self.budget - self.system_tokens
+        user_text = truncate(user_text, max(1, remaining // 2) * config.PROMPT_CHARS_PER_TOKEN)
+        remaining -= estimate_tokens(user_text)
+
+        blocks = []
+        for title, lines, keep_tail in sections:
+            lines = [line for line in lines if line]
+            if not lines:
+                continue
+            remaining -= estimate_tokens(title) + 1
+            kept = []
+            for line in (reversed(lines) if keep_tail else lines):
+                cost = estimate_tokens(line) + 1
+                if cost > remaining:
+                    break
+                kept.append(line)
+                remaining -= cost
+            if not kept:
+                remaining += estimate_tokens(title) + 1
+                continue
+            if keep_tail:
+                kept.reverse()
+            blocks.append(title + "\n" + "\n".join(kept))
+
+        blocks.append(user_text)
+        return [
+            {"role": "system", "content": self.system_prompt},
+            {"role": "user", "content": "\n\n".join(blocks)}
+        ]
+
+
+def messages_tokens(messages):
+    return sum(estimate_tokens(message["content"]) for message in messages)
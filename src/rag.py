@@ -1,102 +1,131 @@
+import heapq
 import numpy as np
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from database import BookStoreDB
 from src.embedding import EmbeddingManager
 import config
 import logging
 
 class RAGSystem:
-  def __init__(self):
+  def __init__(self, background_init = True, vector_enabled = None):
       self.db = BookStoreDB()
       self.embedding_handler = EmbeddingManager()
       
       logging.basicConfig(level=logging.INFO)
       self.logger = logging.getLogger(__name__)
       
-      self._initialize_embeddings()
+      # Đồng bộ embeddings và nạp model chạy nền, tìm kiếm văn bản dùng được ngay
+      self.embeddings_ready = threading.Event()
+      self._search_pool = ThreadPoolExecutor(max_workers=config.VECTOR_SEARCH_WORKERS, thread_name_prefix="vector-search")
+      # Tắt tìm kiếm vector thì không đồng bộ Chroma, không nạp model embedding, chỉ dùng BM25
+      self.vector_enabled = config.VECTOR_SEARCH_ENABLED if vector_enabled is None else vector_enabled
+      if not self.vector_enabled:
+          self.embeddings_ready.set()
+      elif background_init:
+          threading.Thread(target=self._initialize_embeddings, name="embedding-init", daemon=True).start()
+      else:
+          self._initialize_embeddings()
       
   def _initialize_embeddings(self):
       try:
-          books = self.db.search_books()
-          if books:
-              self.embedding_handler.create_book_embeddings(books)
-              self.logger.info(f"Đã khởi tạo embeddings cho {len(books)} cuốn sách")
+          if self.db.has_books():
+              # Đọc sách theo từng trang thay vì nạp cả bảng vào một list
+              self.embedding_handler.sync_book_embeddings(self.db.iter_books())
+              self.logger.info("Đã đồng bộ embeddings cho danh mục sách")
           else:
               self.logger.warning("Không có sách nào trong database")
+          self.embedding_handler.warm_up()
       except Exception as e:
           self.logger.error(f"Lỗi khởi tạo embeddings: {e}")
+      finally:
+          self.embeddings_ready.set()
   
-  def retrieve_relevant_books(self, query, top_k = None):
+  def retrieve_relevant_books(self, query, top_k = None, category = None, min_price = None,
+                              max_price = None, in_stock = False):
       if top_k is None:
           top_k = config.SEARCH_TOP_K
+      filters = {"category": category, "min_price": min_price, "max_price": max_price, "in_stock": in_stock}
           
       try:
-          all_books = self.db.search_books()
-          if not all_books:
+          if not self.db.has_books():
               return []
           
-          text_search_results = self.db.search_books(query=query)
+          candidates = top_k * config.HYBRID_CANDIDATE_MULTIPLIER
           
-          similar_books = []
-          try:
-              similar_books = self.embedding_handler.search_similar_books(query, top_k * 2)
-              valid_similar_books = []
-              for book in similar_books:
-                  db_book = self.db.get_book_by_id(book['book_id'])
-                  if db_book:
-                      db_book['similarity_score'] = book.get('similarity_score', 0)
-                      valid_similar_books.append(db_book)
-              similar_books = valid_similar_books
-          except Exception as e:
-              self.logger.warning(f"Tìm kiếm vector không thành công: {e}, chuyển sang tìm kiếm văn bản")
-              similar_books = []
+          # Tìm kiếm vector chạy song song với BM25 trên thread khác
+          vector_future = None
+          if self.vector_enabled and self.embeddings_ready.is_set():
+              vector_future = self._search_pool.submit(self._vector_search, query, candidates, filters)
           
-          merged_results = self._merge_search_results(similar_books, text_search_results)
+          text_results = self.db.search_books(query=query, limit=candidates, **filters)
           
-          ranked_results = self._rank_results(merged_results, query)
+          vector_hits = []
+          if vector_future is not None:
+              try:
+                  vector_hits = vector_future.result()
+              except Exception as e:
+                  self.logger.warning(f"Tìm kiếm vector không thành công: {e}, chuyển sang tìm kiếm văn bản")
           
-          return ranked_results[:top_k]
+          return self._fuse_results(text_results, vector_hits, top_k, filters)
           
       except Exception as e:
           self.logger.error(f"Lỗi trong retrieve_relevant_books: {e}")
-          return self.db.search_books(query=query)[:top_k] if top_k else self.db.search_books(query=query)
+          return self.db.search_books(query=query, limit=top_k, **filters)
+  
+  def _vector_search(self, query, candidates, filters):
+      return self.embedding_handler.search_similar_books(query, candidates, where=self._vector_where(filters))
+  
+  def _vector_where(self, filters):
+      # Chỉ đẩy thể loại xuống Chroma: tồn kho và giá đổi sau mỗi đơn hàng nên metadata có thể cũ,
+      # loại theo chúng ở đây sẽ bỏ sót sách vừa nhập hàng; _fuse_results kiểm tra lại trên SQLite
+      if filters["category"]:
+          return {"category": {"$eq": filters["category"]}}
+      return None
   
-  def _merge_search_results(self, vector_results, text_results):
-      merged = {}
+  def _fuse_results(self, text_results, vector_hits, top_k, filters):
+      # Reciprocal-rank fusion: chỉ dùng thứ hạng nên không cần chuẩn hóa điểm BM25 và cosine
+      scores = {}
+      books = {}
+      for rank, book in enumerate(text_results, 1):
+          scores[book['book_id']] = config.HYBRID_TEXT_WEIGHT / (config.RRF_K + rank)
+          books[book['book_id']] = dict(book, search_type='text')
       
-      for book in vector_results:
-          book_id = book['book_id']
-          merged[book_id] = book.copy()
-          merged[book_id]['search_type'] = 'vector'
+      similarity = {}
+      for rank, hit in enumerate(vector_hits, 1):
+          book_id = hit['book_id']
+          similarity[book_id] = hit.get('similarity_score', 0)
+          scores[book_id] = scores.get(book_id, 0) + config.HYBRID_VECTOR_WEIGHT / (config.RRF_K + rank)
       
-      for book in text_results:
-          book_id = book['book_id']
-          if book_id not in merged:
-              book_copy = book.copy()
-              book_copy['similarity_score'] = 0.5  
-              book_copy['search_type'] = 'text'
-              merged[book_id] = book_copy
-          else:
-              merged[book_id]['similarity_score'] = min(1.0, merged[book_id]['similarity_score'] + 0.2)
-              merged[book_id]['search_type'] = 'hybrid'
+      # Metadata trong Chroma có thể cũ (tồn kho, giá), nên lấy bản ghi từ SQLite và kiểm tra lại bộ lọc
+      missing_ids = [book_id for book_id in similarity if book_id not in books]
+      for book in self.db.get_books_by_ids(missing_ids):
+          if self._matches_filters(book, filters):
+              books[book['book_id']] = dict(book, search_type='vector')
       
-      return list(merged.values())
-  
-  def _rank_results(self, results, query):
-      for book in results:
-          score = book.get('similarity_score', 0)
-          
-          if book.get('stock', 0) > 0:
-              score += 0.1
-          
-          query_lower = query.lower()
-          if query_lower in book.get('title', '').lower():
-              score += 0.3
-          if query_lower in book.get('author', '').lower():
-              score += 0.2
-          
-          book['final_score'] = score
+      top = heapq.nlargest(top_k, (book_id for book_id in scores if book_id in books), key=scores.__getitem__)
       
-      return sorted(results, key=lambda x: x.get('final_score', 0), reverse=True)
+      results = []
+      for book_id in top:
+          book = books[book_id]
+          if book_id in similarity:
+              book['similarity_score'] = similarity[book_id]
+              if book['search_type'] == 'text':
+                  book['search_type'] = 'hybrid'
+          book['final_score'] = scores[book_id]
+          results.append(book)
+      return results
+  
+  def _matches_filters(self, book, filters):
+      if filters["category"] and book['category'] != filters["category"]:
+          return False
+      if filters["min_price"] is not None and book['price'] < filters["min_price"]:
+          return False
+      if filters["max_price"] is not None and book['price'] > filters["max_price"]:
+          return False
+      if filters["in_stock"] and book['stock'] <= 0:
+          return False
+      return True
   
   def find_book_for_order(self, book_title):
       try:
@@ -107,14 +136,16 @@ class RAGSystem:
                   if book['title'].lower() == book_title.lower():
                       return book
               
-              try:
-                  similar_books = self.embedding_handler.search_similar_books(book_title, n_results=1)
-                  if similar_books and similar_books[0].get('similarity_score', 0) > 0.8:
-                      found_book = self.db.get_book_by_id(similar_books[0]['book_id'])
-                      if found_book:
-                          return found_book
-              except:
-                  pass
+              # Như retrieve_relevant_books: không chờ model đang nạp nền, không dùng vector khi đã tắt
+              if self.vector_enabled and self.embeddings_ready.is_set():
+                  try:
+                      similar_books = self.embedding_handler.search_similar_books(book_title, top_k=1)
+                      if similar_books and similar_books[0].get('similarity_score', 0) > 0.8:
+                          found_book = self.db.get_book_by_id(similar_books[0]['book_id'])
+                          if found_book:
+                              return found_book
+                  except Exception as e:
+                      self.logger.warning(f"Tìm sách bằng vector không thành công: {e}, dùng kết quả văn bản")
               
               return books[0]
           
@@ -126,17 +157,9 @@ class RAGSystem:
   
   def get_statistics(self):
       try:
-          total_books = self.db.count_books()
-          
-          all_books = self.db.search_books()
-          categories = {}
-          for book in all_books:
-              cat = book.get('category', 'Khác')
-              categories[cat] = categories.get(cat, 0) + 1
-          
           return {
-              'total_books': total_books,
-              'categories': categories,
+              'total_books': self.db.count_books(),
+              'categories': self.db.count_books_by_category(),
               'embedding_model': config.EMBEDDING_MODEL,
               'vector_db_collection': config.CHROMA_COLLECTION_NAME
           }
@@ -0,0 +1,92 @@
+import os
+import sys
+import time
+import threading
+import unicodedata
+from collections import OrderedDict, defaultdict
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config
+
+
+def stock_bucket(stock):
+    if stock <= 0:
+        return "out"
+    if stock <= 5:
+        return "low"
+    if stock <= 20:
+        return "some"
+    return "many"
+
+
+class ResponseCache:
+    def __init__(self, ttl=config.RESPONSE_CACHE_TTL, max_entries=config.RESPONSE_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        # key -> (response, book_ids, expires_at)
+        self._entries = OrderedDict()
+        self._book_keys = defaultdict(set)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(query, books, model_name, prompt_version):
+        normalized = " ".join(unicodedata.normalize("NFC", query).lower().split())
+        books_key = tuple(
+            (book['book_id'], book['price'], stock_bucket(book['stock'])) for book in books
+        )
+        return (normalized, books_key, model_name, prompt_version)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[2] < time.time():
+                if entry is not None:
+                    self._discard(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, response):
+        book_ids = [book_id for book_id, _, _ in key[1]]
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = (response, book_ids, time.time() + self.ttl)
+            for book_id in book_ids:
+                self._book_keys[book_id].add(key)
+
+            while len(self._entries) > self.max_entries:
+                self._discard(next(iter(self._entries)))
+
+    def invalidate_book(self, book_id):
+        with self._lock:
+            for key in list(self._book_keys.get(book_id, ())):
+                self._discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._book_keys.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "entries": len(self._entries)
+            }
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for book_id in entry[1]:
+            keys = self._book_keys.get(book_id)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._book_keys[book_id]
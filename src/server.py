@@ -0,0 +1,413 @@
+import os
+import re
+import sys
+import json
+import uuid
+import base64
+import struct
+import asyncio
+import hashlib
+import argparse
+from http import HTTPStatus
+from http.cookies import SimpleCookie
+from urllib.parse import urlsplit, parse_qs
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config
+import logging
+
+logger = logging.getLogger(__name__)
+
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+WS_TEXT, WS_CLOSE, WS_PING, WS_PONG = 0x1, 0x8, 0x9, 0xA
+SESSION_COOKIE = "bookstore_session"
+MAX_HEADER_BYTES = 16 * 1024
+# session_id do client gửi được ghi lại vào Set-Cookie: chỉ nhận ký tự an toàn cho header
+SESSION_ID_RE = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message=None):
+        super().__init__(message or status.phrase)
+        self.status = status
+        self.message = message or status.phrase
+
+
+class Request:
+    def __init__(self, method, target, version, headers, body=b""):
+        url = urlsplit(target)
+        self.method = method
+        self.path = url.path
+        self.query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        self.version = version
+        self.headers = headers
+        self.body = body
+
+    @property
+    def keep_alive(self):
+        connection = self.headers.get("connection", "").lower()
+        if self.version == "HTTP/1.0":
+            return connection == "keep-alive"
+        return connection != "close"
+
+    def json(self):
+        try:
+            payload = json.loads(self.body or b"{}")
+        except ValueError:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Body không phải JSON hợp lệ")
+        if not isinstance(payload, dict):
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Body phải là JSON object")
+        return payload
+
+    def cookie(self, name):
+        cookies = SimpleCookie(self.headers.get("cookie", ""))
+        return cookies[name].value if name in cookies else None
+
+
+class ChatServer:
+    def __init__(self, chatbot, host=config.SERVER_HOST, port=config.SERVER_PORT,
+                 max_concurrent=config.SERVER_MAX_CONCURRENT_TURNS, max_pending=config.SERVER_MAX_PENDING_TURNS,
+                 request_timeout=config.SERVER_REQUEST_TIMEOUT, keep_alive_timeout=config.SERVER_KEEP_ALIVE_TIMEOUT,
+                 ws_idle_timeout=config.SERVER_WS_IDLE_TIMEOUT, max_body=config.SERVER_MAX_BODY_BYTES):
+        self.chatbot = chatbot
+        self.host = host
+        self.port = port
+        self.max_concurrent = max_concurrent
+        self.max_pending = max_pending
+        self.request_timeout = request_timeout
+        self.keep_alive_timeout = keep_alive_timeout
+        self.ws_idle_timeout = ws_idle_timeout
+        self.max_body = max_body
+
+        self._turn_slots = asyncio.Semaphore(max_concurrent)
+        self._turns = 0
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(
+            self._handle_connection, self.host, self.port, limit=MAX_HEADER_BYTES
+        )
+        sockets = ", ".join(str(sock.getsockname()) for sock in self._server.sockets)
+        logger.info(f"Server chatbot đang lắng nghe tại {sockets}")
+        return self._server
+
+    async def serve_forever(self):
+        server = self._server or await self.start()
+        async with server:
+            await server.serve_forever()
+
+    async def _handle_connection(self, reader, writer):
+        # Mỗi kết nối có một session mặc định, dùng khi client không gửi session_id/cookie
+        connection_session = uuid.uuid4().hex
+        try:
+            while True:
+                try:
+                    request = await self._read_request(reader)
+                except HTTPError as e:
+                    await self._send_json(writer, e.status, {"error": e.message}, keep_alive=False)
+                    return
+                if request is None:
+                    return
+
+                if request.path == "/ws":
+                    await self._handle_websocket(request, reader, writer, connection_session)
+                    return
+
+                keep_alive = request.keep_alive
+                try:
+                    keep_alive = await self._dispatch(request, writer, connection_session) and keep_alive
+                except HTTPError as e:
+                    await self._send_json(writer, e.status, {"error": e.message}, keep_alive=keep_alive)
+                if not keep_alive:
+                    return
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            logger.error(f"Lỗi xử lý kết nối: {e}")
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+
+    async def _read_request(self, reader):
+        try:
+            # Kết nối keep-alive rảnh quá lâu thì đóng để giải phóng socket
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.keep_alive_timeout)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+            return None
+        except asyncio.LimitOverrunError:
+            raise HTTPError(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE)
+
+        lines = head.decode("latin-1").split("\r\n")
+        try:
+            method, target, version = lines[0].split(" ", 2)
+        except ValueError:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Dòng yêu cầu không hợp lệ")
+
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+
+        if "chunked" in headers.get("transfer-encoding", "").lower():
+            raise HTTPError(HTTPStatus.LENGTH_REQUIRED)
+        try:
+            length = int(headers.get("content-length") or 0)
+        except ValueError:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Content-Length không hợp lệ")
+        if length < 0:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Content-Length không hợp lệ")
+        if length > self.max_body:
+            raise HTTPError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+
+        body = b""
+        if length:
+            try:
+                body = await asyncio.wait_for(reader.readexactly(length), self.request_timeout)
+            except asyncio.TimeoutError:
+                raise HTTPError(HTTPStatus.REQUEST_TIMEOUT)
+        return Request(method.upper(), target, version, headers, body)
+
+    async def _dispatch(self, request, writer, connection_session):
+        if request.path == "/health" and request.method == "GET":
+            readiness = self.chatbot.readiness()
+            status = HTTPStatus.OK if readiness["embeddings"] and readiness["llm"] else HTTPStatus.SERVICE_UNAVAILABLE
+            await self._send_json(writer, status, {"ready": status == HTTPStatus.OK, **readiness,
+                                                   "turns_in_flight": self._turns}, request.keep_alive)
+            return True
+
+        if request.path == "/metrics" and request.method == "GET":
+            await self._send_json(writer, HTTPStatus.OK, {
+                "turns_in_flight": self._turns,
+                "llm_scheduler": self.chatbot.llm_handler.scheduler.stats(),
+                "llm_breaker": self.chatbot.llm_handler.breaker_stats(),
+                "response_cache": self.chatbot.llm_handler.response_cache.stats()
+            }, request.keep_alive)
+            return True
+
+        if request.path in ("/chat", "/chat/stream"):
+            if request.method != "POST":
+                raise HTTPError(HTTPStatus.METHOD_NOT_ALLOWED)
+            payload = request.json()
+            message = str(payload.get("message") or "").strip()
+            if not message:
+                raise HTTPError(HTTPStatus.BAD_REQUEST, "Thiếu trường message")
+            session_id = self._session_id(request, payload.get("session_id"), connection_session)
+
+            if request.path == "/chat":
+                response = await self._run_turn(message, session_id)
+                await self._send_json(writer, HTTPStatus.OK, {"session_id": session_id, "response": response},
+                                      request.keep_alive, session_id)
+                return True
+            return await self._stream_sse(request, writer, message, session_id)
+
+        raise HTTPError(HTTPStatus.NOT_FOUND)
+
+    def _session_id(self, request, requested, connection_session):
+        # Cùng thứ tự cho REST, SSE và WebSocket: session_id client gửi, cookie, rồi session của kết nối
+        for candidate in (requested, request.cookie(SESSION_COOKIE)):
+            if isinstance(candidate, str) and SESSION_ID_RE.match(candidate):
+                return candidate
+        return connection_session
+
+    async def _run_turn(self, message, session_id, on_token=None):
+        # Giới hạn số lượt chờ: quá tải thì từ chối ngay thay vì để độ trễ tăng vô hạn
+        if self._turns >= self.max_concurrent + self.max_pending:
+            raise HTTPError(HTTPStatus.SERVICE_UNAVAILABLE, "Server đang quá tải, vui lòng thử lại sau")
+
+        # Một hạn chót cho cả thời gian chờ slot lẫn xử lý lượt
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.request_timeout
+        self._turns += 1
+        try:
+            try:
+                await asyncio.wait_for(self._turn_slots.acquire(), self.request_timeout)
+            except asyncio.TimeoutError:
+                raise HTTPError(HTTPStatus.SERVICE_UNAVAILABLE, "Server đang quá tải, vui lòng thử lại sau")
+            try:
+                turn = asyncio.ensure_future(
+                    self.chatbot.aprocess_message(message, session_id=session_id, on_token=on_token)
+                )
+                try:
+                    return await asyncio.wait_for(asyncio.shield(turn), max(0, deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    if self.chatbot.is_committing(session_id):
+                        # Đơn hàng đang được ghi trên thread khác và sẽ hoàn tất dù lượt bị hủy:
+                        # chờ và trả kết quả thật thay vì báo hết thời gian cho một đơn đã đặt
+                        logger.warning(f"Lượt của session {session_id} quá hạn khi đang ghi đơn hàng, chờ kết quả")
+                        return await turn
+                    turn.cancel()
+                    raise HTTPError(HTTPStatus.GATEWAY_TIMEOUT, "Hết thời gian xử lý tin nhắn")
+                except asyncio.CancelledError:
+                    turn.cancel()
+                    raise
+            finally:
+                self._turn_slots.release()
+        finally:
+            self._turns -= 1
+
+    async def _stream_sse(self, request, writer, message, session_id):
+        headers = {
+            "Content-Type": "text/event-stream; charset=utf-8",
+            "Cache-Control": "no-cache",
+            "Transfer-Encoding": "chunked",
+        }
+        started = False
+
+        async def send_event(event, data):
+            nonlocal started
+            if not started:
+                started = True
+                self._write_head(writer, HTTPStatus.OK, headers, request.keep_alive, session_id)
+            payload = f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8")
+            writer.write(b"%x\r\n%s\r\n" % (len(payload), payload))
+            # Client đọc chậm thì dừng lấy token tiếp theo từ LLM
+            await writer.drain()
+
+        try:
+            response = await self._run_turn(message, session_id, lambda token: send_event("token", token))
+            await send_event("done", {"session_id": session_id, "response": response})
+        except HTTPError as e:
+            if not started:
+                raise
+            await send_event("error", {"error": e.message})
+
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+        return True
+
+    def _write_head(self, writer, status, headers, keep_alive, session_id=None):
+        lines = [f"HTTP/1.1 {status.value} {status.phrase}"]
+        headers = dict(headers)
+        headers["Connection"] = "keep-alive" if keep_alive else "close"
+        if keep_alive:
+            headers["Keep-Alive"] = f"timeout={self.keep_alive_timeout}"
+        if session_id:
+            headers["Set-Cookie"] = f"{SESSION_COOKIE}={session_id}; Path=/; HttpOnly; SameSite=Lax"
+        lines.extend(f"{name}: {value}" for name, value in headers.items())
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+
+    async def _send_json(self, writer, status, data, keep_alive=True, session_id=None):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        headers = {"Content-Type": "application/json; charset=utf-8", "Content-Length": len(body)}
+        if status == HTTPStatus.SERVICE_UNAVAILABLE:
+            headers["Retry-After"] = 1
+        self._write_head(writer, status, headers, keep_alive, session_id)
+        writer.write(body)
+        await writer.drain()
+
+    async def _handle_websocket(self, request, reader, writer, connection_session):
+        key = request.headers.get("sec-websocket-key")
+        if request.headers.get("upgrade", "").lower() != "websocket" or not key:
+            await self._send_json(writer, HTTPStatus.BAD_REQUEST, {"error": "Yêu cầu WebSocket không hợp lệ"}, False)
+            return
+
+        accept = base64.b64encode(hashlib.sha1((key + WS_GUID).encode()).digest()).decode()
+        session_id = self._session_id(request, request.query.get("session_id"), connection_session)
+        writer.write((
+            "HTTP/1.1 101 Switching Protocols\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            f"Sec-WebSocket-Accept: {accept}\r\n\r\n"
+        ).encode())
+        await writer.drain()
+
+        async def send(data):
+            await self._ws_send(writer, WS_TEXT, json.dumps(data, ensure_ascii=False).encode("utf-8"))
+
+        await send({"type": "session", "session_id": session_id})
+        # Tin nhắn trên cùng một kết nối được xử lý lần lượt, client gửi nhanh sẽ bị chặn bởi TCP
+        while True:
+            try:
+                opcode, payload = await asyncio.wait_for(self._ws_receive(reader, writer), self.ws_idle_timeout)
+            except asyncio.TimeoutError:
+                await self._ws_send(writer, WS_CLOSE, struct.pack("!H", 1001))
+                return
+            if opcode == WS_CLOSE:
+                await self._ws_send(writer, WS_CLOSE, payload[:2])
+                return
+
+            text = payload.decode("utf-8", errors="replace")
+            try:
+                message = str(json.loads(text).get("message") or "").strip()
+            except (ValueError, AttributeError):
+                message = text.strip()
+            if not message:
+                await send({"type": "error", "error": "Tin nhắn rỗng"})
+                continue
+
+            try:
+                response = await self._run_turn(message, session_id, lambda token: send({"type": "token", "data": token}))
+                await send({"type": "done", "response": response})
+            except HTTPError as e:
+                await send({"type": "error", "error": e.message})
+
+    async def _ws_receive(self, reader, writer):
+        fragments = []
+        while True:
+            first, second = await reader.readexactly(2)
+            fin, opcode = first & 0x80, first & 0x0F
+            length = second & 0x7F
+            if length == 126:
+                length = struct.unpack("!H", await reader.readexactly(2))[0]
+            elif length == 127:
+                length = struct.unpack("!Q", await reader.readexactly(8))[0]
+            if length > self.max_body:
+                await self._ws_send(writer, WS_CLOSE, struct.pack("!H", 1009))
+                raise ConnectionError("WebSocket frame quá lớn")
+
+            mask = await reader.readexactly(4) if second & 0x80 else None
+            payload = await reader.readexactly(length)
+            if mask and length:
+                # Bỏ mask bằng một phép XOR trên số nguyên lớn thay vì lặp từng byte
+                key = (mask * (length // 4 + 1))[:length]
+                payload = (int.from_bytes(payload, "big") ^ int.from_bytes(key, "big")).to_bytes(length, "big")
+
+            if opcode == WS_PING:
+                await self._ws_send(writer, WS_PONG, payload)
+            elif opcode == WS_PONG:
+                continue
+            elif opcode == WS_CLOSE:
+                return opcode, payload
+            else:
+                fragments.append(payload)
+                if sum(len(fragment) for fragment in fragments) > self.max_body:
+                    await self._ws_send(writer, WS_CLOSE, struct.pack("!H", 1009))
+                    raise ConnectionError("Tin nhắn WebSocket quá lớn")
+                if fin:
+                    return WS_TEXT, b"".join(fragments)
+
+    async def _ws_send(self, writer, opcode, payload):
+        length = len(payload)
+        if length < 126:
+            header = struct.pack("!BB", 0x80 | opcode, length)
+        elif length < 65536:
+            header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+        writer.write(header + payload)
+        await writer.drain()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Server HTTP/SSE/WebSocket cho BookStore Chatbot")
+    parser.add_argument("--host", default=config.SERVER_HOST)
+    parser.add_argument("--port", type=int, default=config.SERVER_PORT)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    from chatbot import BookStoreChatbot
+    chatbot = BookStoreChatbot()
+    server = ChatServer(chatbot, host=args.host, port=args.port)
+
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        logger.info("Đã dừng server")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+import os
+import sys
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class InMemorySessionStore:
+    def __init__(self, ttl=config.SESSION_TIMEOUT, max_sessions=config.MAX_SESSIONS,
+                 max_history=config.MAX_CONVERSATION_HISTORY):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.max_history = max_history
+        # session_id -> (session, last_access), theo thứ tự truy cập cũ nhất trước
+        self._sessions = OrderedDict()
+        # session_id -> số lượt đang xử lý; các session này không bị xóa khi hết hạn/vượt max_sessions
+        self._held = {}
+        self._lock = threading.RLock()
+
+    def new_session(self, history=()):
+        return {
+            "intent": None,
+            "pending_order": None,
+            "editing_fields": None,
+            "last_books": [],
+            "conversation_history": deque(history, maxlen=self.max_history)
+        }
+
+    def get(self, session_id):
+        with self._lock:
+            self.evict_expired()
+            entry = self._sessions.get(session_id)
+            session = entry[0] if entry else self._load(session_id)
+            if session is None:
+                session = self.new_session()
+            self._touch(session_id, session)
+            return session
+
+    def acquire(self, session_id):
+        # Giữ session trong suốt một lượt để handler tra lại bằng store[session_id] không gặp KeyError
+        with self._lock:
+            session = self.get(session_id)
+            self._held[session_id] = self._held.get(session_id, 0) + 1
+            return session
+
+    def release(self, session_id):
+        with self._lock:
+            count = self._held.pop(session_id, 0) - 1
+            if count > 0:
+                self._held[session_id] = count
+
+    def __getitem__(self, session_id):
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                raise KeyError(session_id)
+            return entry[0]
+
+    def __contains__(self, session_id):
+        with self._lock:
+            return session_id in self._sessions
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
+
+    def save(self, session_id):
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is not None:
+                self._touch(session_id, entry[0])
+                self._persist(session_id, entry[0])
+
+    def delete(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+            self._remove(session_id)
+
+    def evict_expired(self):
+        with self._lock:
+            deadline = time.time() - self.ttl
+            for _ in range(len(self._sessions)):
+                session_id, (_, last_access) = next(iter(self._sessions.items()))
+                if last_access >= deadline:
+                    break
+                self._evict_oldest()
+
+    def _touch(self, session_id, session):
+        self._sessions[session_id] = (session, time.time())
+        self._sessions.move_to_end(session_id)
+        for _ in range(len(self._sessions)):
+            if len(self._sessions) <= self.max_sessions:
+                break
+            self._evict_oldest()
+
+    def _evict_oldest(self):
+        session_id, (session, _) = self._sessions.popitem(last=False)
+        if session_id in self._held:
+            # Session đang có lượt xử lý: làm mới và đưa về cuối thay vì xóa
+            self._sessions[session_id] = (session, time.time())
+
+    # Các hook cho store có lưu trữ bền vững
+    def _load(self, session_id):
+        return None
+
+    def _persist(self, session_id, session):
+        pass
+
+    def _remove(self, session_id):
+        pass
+
+
+class SQLiteSessionStore(InMemorySessionStore):
+    PURGE_INTERVAL = 100
+
+    def __init__(self, db_path=config.SESSION_DB_PATH, **kwargs):
+        super().__init__(**kwargs)
+        self.db_path = str(db_path)
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode = WAL")
+        self._conn.execute("PRAGMA synchronous = NORMAL")
+        self._conn.execute('''
+        CREATE TABLE IF NOT EXISTS sessions (
+                       session_id TEXT PRIMARY KEY,
+                       data TEXT NOT NULL,
+                       updated_at REAL NOT NULL
+                       )
+''')
+        self._conn.commit()
+        self._saves = 0
+
+    def _load(self, session_id):
+        row = self._conn.execute(
+            'SELECT data FROM sessions WHERE session_id = ? AND updated_at >= ?',
+            (session_id, time.time() - self.ttl)
+        ).fetchone()
+        if not row:
+            return None
+
+        data = json.loads(row[0])
+        session = self.new_session(data.pop("conversation_history", []))
+        session.update(data)
+        return session
+
+    def _persist(self, session_id, session):
+        data = dict(session)
+        data["conversation_history"] = list(session["conversation_history"])
+        with self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO sessions (session_id, data, updated_at) VALUES (?, ?, ?)',
+                (session_id, json.dumps(data, ensure_ascii=False, default=str), time.time())
+            )
+
+        self._saves += 1
+        if self._saves % self.PURGE_INTERVAL == 0:
+            self.purge_expired()
+
+    def _remove(self, session_id):
+        with self._conn:
+            self._conn.execute('DELETE FROM sessions WHERE session_id = ?', (session_id,))
+
+    def purge_expired(self):
+        with self._lock, self._conn:
+            cursor = self._conn.execute('DELETE FROM sessions WHERE updated_at < ?', (time.time() - self.ttl,))
+            if cursor.rowcount:
+                logger.info(f"Đã xóa {cursor.rowcount} session hết hạn")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def create_session_store(backend=config.SESSION_STORE):
+    if backend == "sqlite":
+        return SQLiteSessionStore()
+    return InMemorySessionStore()
@@ -0,0 +1,36 @@
+import os
+import sys
+import threading
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.extend([ROOT, os.path.join(ROOT, 'src')])
+
+import pytest
+
+
+@pytest.fixture
+def rag_system(tmp_path, monkeypatch):
+    # BookStoreDB và Chroma dùng đường dẫn tương đối data/...
+    monkeypatch.chdir(tmp_path)
+    import rag
+
+    # Giữ luồng khởi tạo embeddings chưa xong để mô phỏng lượt đặt hàng đến sớm
+    release = threading.Event()
+    monkeypatch.setattr(rag.RAGSystem, "_initialize_embeddings", lambda self: release.wait(5))
+    system = rag.RAGSystem(vector_enabled=True)
+    yield system
+    release.set()
+    system.db.close()
+
+
+def test_order_lookup_before_embeddings_ready_does_not_load_model(rag_system, monkeypatch):
+    calls = []
+    monkeypatch.setattr(rag_system.embedding_handler, "search_similar_books",
+                        lambda *args, **kwargs: calls.append(args) or [])
+    assert not rag_system.embeddings_ready.is_set()
+
+    # Tên không khớp chính xác: trước đây sẽ rơi vào tìm kiếm vector và nạp model
+    book = rag_system.find_book_for_order("nha gia kim")
+
+    assert book is not None
+    assert calls == []
+    assert not rag_system.embedding_handler.model_loaded